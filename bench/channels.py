@@ -0,0 +1,58 @@
+"""Checks that indexing a file scales linearly with its transitions.
+
+Usage: python -m bench.channels [max transitions] [repeats]
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+from bench.generate import write_file
+from chrom.file import File
+
+
+def quadratic_channels(precursors):
+    """The channel assignment that File.parse replaced."""
+    channels = []
+    for i, precursor in enumerate(precursors):
+        channels.append(sum(1 for p in precursors[:i]
+                            if precursor > 0.0 and p == precursor))
+    return channels
+
+
+def main(transitions=8000, repeats=5):
+    sizes = [transitions // 8, transitions // 4, transitions // 2, transitions]
+    per_trace = []
+    print('{:>8} {:>10} {:>12} {:>12}'.format(
+        'traces', 'index (s)', 'us/trace', 'legacy (s)'))
+    for size in sizes:
+        fd, path = tempfile.mkstemp(suffix='.txt')
+        os.close(fd)
+        try:
+            # Four transitions per precursor, a few rows each
+            write_file(path, events=size // 4, channels=4, points=10)
+            file = File(path)
+            precursors = file.store.columns['precursor'].tolist()
+            assert quadratic_channels(precursors) == \
+                file.store.columns['channel'].tolist()
+            index = min(timeit.repeat(lambda: File(path),
+                                      number=3, repeat=repeats)) / 3
+            legacy = min(timeit.repeat(
+                lambda: quadratic_channels(precursors),
+                number=1, repeat=repeats))
+        finally:
+            os.remove(path)
+        per_trace.append(index / len(precursors))
+        print('{:>8} {:>10.4f} {:>12.2f} {:>12.4f}'.format(
+            len(precursors), index, per_trace[-1] * 1e6, legacy))
+
+    growth = per_trace[-1] / per_trace[0]
+    print('per trace cost grew {:.2f}x over {}x more traces'.format(
+        growth, sizes[-1] // sizes[0]))
+    if growth > 2.0:
+        print('regression: indexing is not linear')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:3]])
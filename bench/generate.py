@@ -0,0 +1,124 @@
+"""Writes synthetic LabSolutions ASCII exports for benchmarking.
+
+Usage: python -m bench.generate <path> [events] [channels] [points]
+                                [--noise N] [--drift N] [--shape SHAPE]
+                                [--width MIN] [--peaks N] [--crlf]
+"""
+import argparse
+import sys
+
+import numpy
+
+HEADER = ("[Header]\n"
+          "Application Name{d}LabSolutions\n"
+          "Version{d}5.82\n"
+          "\n"
+          "[Sample Information]\n"
+          "Operator{d}System Administrator\n"
+          "Sample Type{d}Unknown\n"
+          "Sample Name{d}{name}\n"
+          "Sample ID{d}{id}\n"
+          "Injection Volume{d}10\n"
+          "\n")
+
+CHROMATOGRAM = ("[MS Chromatogram]\n"
+                "m/z 1-{event}MS(E{ion_mode}) {label}\n"
+                "Segment{d}1\n"
+                "Event{d}{event}\n"
+                "Intensity Units{d}counts\n"
+                "# of Points{d}{points}\n"
+                "R.Time (min){d}Intensity\n")
+
+
+SHAPES = ['gaussian', 'tailing', 'fronting']
+
+
+def peak_shape(times, apex, width, shape='gaussian', asymmetry=3.0):
+    """Unit height peak at 'apex'. Tailing and fronting peaks are
+    bi-gaussian, the trailing or leading side 'asymmetry' times wider."""
+    left = width * (asymmetry if shape == 'fronting' else 1.0)
+    right = width * (asymmetry if shape == 'tailing' else 1.0)
+    sigma = numpy.where(times < apex, left, right)
+    return numpy.exp(-0.5 * ((times - apex) / sigma) ** 2)
+
+
+def write_file(path, events=34, channels=2, points=3000,
+               name='Synthetic', id=1, delim='\t', seed=0,
+               noise=50.0, drift=0.0, shape='gaussian', width=0.05,
+               peaks=1, newline='\n'):
+    """Writes an export with a TIC and 'channels' MRM transitions for each
+    event, every trace holding 'points' rows of peaks on noise.
+    noise -> mean of the poisson background, in counts.
+    drift -> rise of the background over the run, in counts.
+    shape -> peak shape, one of SHAPES, or 'mixed' to cycle through them.
+    width -> standard deviation of a peak, in minutes.
+    peaks -> peaks per trace, the first at the event's retention time and
+             the rest at random times with lower heights.
+    newline -> line ending, LabSolutions writes '\r\n'."""
+    rng = numpy.random.RandomState(seed)
+    times = numpy.linspace(0.003, 15.0, points)
+    background = drift * times / times[-1]
+    with open(path, 'w', newline='') as fp:
+        fp.write(HEADER.format(d=delim, name=name, id=id)
+                 .replace('\n', newline))
+        total = numpy.zeros(points, dtype=int)
+        transitions = []
+        for event in range(1, events + 1):
+            precursor = 200.0 + 50.0 * event + 0.9
+            apex = 1.0 + 13.0 * event / events
+            for channel in range(channels):
+                product = precursor - 44.0 - 20.0 * channel
+                kind = SHAPES[len(transitions) % len(SHAPES)] \
+                    if shape == 'mixed' else shape
+                height = rng.uniform(1e3, 1e6)
+                signal = height * peak_shape(times, apex, width, kind)
+                for _ in range(peaks - 1):
+                    signal += rng.uniform(0.05, 0.5) * height * peak_shape(
+                        times, rng.uniform(1.0, 14.0), width, kind)
+                responses = (signal + background +
+                             rng.poisson(noise, points)).astype(int)
+                total += responses
+                transitions.append((event, precursor, product, responses))
+
+        _write_chromatogram(fp, 1, 'TIC', times, total, delim, newline)
+        for event, precursor, product, responses in transitions:
+            _write_chromatogram(
+                fp, event, 'm/z {:.2f}>{:.2f}'.format(precursor, product),
+                times, responses, delim, newline)
+
+
+def _write_chromatogram(fp, event, label, times, responses, delim, newline):
+    fp.write(CHROMATOGRAM.format(d=delim, event=event, ion_mode='-',
+                                 label=label, points=len(times))
+             .replace('\n', newline))
+    fp.write(newline.join('{:.3f}{}{}'.format(t, delim, r)
+                          for t, r in zip(times, responses)))
+    fp.write(newline * 2)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description='Writes a synthetic LabSolutions ASCII export.')
+    parser.add_argument('path')
+    parser.add_argument('events', nargs='?', type=int, default=34)
+    parser.add_argument('channels', nargs='?', type=int, default=2,
+                        help='MRM transitions per precursor.')
+    parser.add_argument('points', nargs='?', type=int, default=3000)
+    parser.add_argument('--noise', type=float, default=50.0)
+    parser.add_argument('--drift', type=float, default=0.0)
+    parser.add_argument('--shape', choices=SHAPES + ['mixed'],
+                        default='gaussian')
+    parser.add_argument('--width', type=float, default=0.05)
+    parser.add_argument('--peaks', type=int, default=1)
+    parser.add_argument('--crlf', action='store_true',
+                        help='End lines with \\r\\n.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(args)
+    write_file(args.path, args.events, args.channels, args.points,
+               seed=args.seed, noise=args.noise, drift=args.drift,
+               shape=args.shape, width=args.width, peaks=args.peaks,
+               newline='\r\n' if args.crlf else '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,44 @@
+"""Times a filtered selection against loading every trace of a file.
+
+Usage: python -m bench.lazy [events] [channels] [points] [repeats]
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+from bench.generate import write_file
+from chrom.file import File
+from chrom.filter import Filter
+
+
+def select(path, filter):
+    file = File(path)
+    traces = Filter(filter).filter(file)
+    return file, traces
+
+
+def main(events=34, channels=2, points=3000, repeats=3):
+    fd, path = tempfile.mkstemp(suffix='.txt')
+    os.close(fd)
+    try:
+        write_file(path, events, channels, points)
+        filter = 'event=[14,15]'
+        file, traces = select(path, filter)
+        rows = sum(len(t.responses) for t in traces)
+        total = sum(len(t.responses) for t in file.traces)
+        print('selected {} of {} traces, {:.1%} of data rows'.format(
+            len(traces), len(file.traces), rows / total))
+
+        full = min(timeit.repeat(lambda: File(path).load(),
+                                 number=1, repeat=repeats))
+        lazy = min(timeit.repeat(lambda: select(path, filter),
+                                 number=1, repeat=repeats))
+        print('full:  {:.3f} s\nlazy:  {:.3f} s\nspeedup: {:.1f}x'.format(
+            full, lazy, full / lazy))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:5]])
@@ -0,0 +1,109 @@
+"""Compares the bulk section parser against the original line loop.
+
+Usage: python -m bench.parse [events] [channels] [points] [repeats]
+"""
+import os
+import re
+import sys
+import tempfile
+import timeit
+
+import numpy
+
+from bench.generate import write_file
+from chrom.file import File
+
+
+class LegacyTrace(object):
+    def __init__(self):
+        self.mode, self.ion_mode = 'tic', '+'
+        self.event, self.channel = 0, 0
+        self.precursor, self.product = 0.0, 0.0
+
+    def same_channel(self, other):
+        return self.precursor > 0.0 and self.precursor == other.precursor
+
+
+def legacy_parse(path):
+    """The per-line parser that File.parse replaced."""
+    name, id, traces = "", -1, []
+    with open(path) as fp:
+        line = fp.readline()  # Skip header
+        line = fp.readline()
+        delim = re.match('.*(.)LabSolutions\n', line).group(1)
+        while line:
+            if line == '[Sample Information]\n':
+                while line != '\n':
+                    info = line.split(delim)
+                    if info[0] == 'Sample Name':
+                        name = info[1].rstrip()
+                    elif info[0] == 'Sample ID':
+                        id = info[1].rstrip()
+                    line = fp.readline()
+            elif line == '[MS Chromatogram]\n':
+                tracedata = LegacyTrace()
+                line = fp.readline().rstrip()
+                m_type = re.match(r'm/z.(\d+)-(\d+)MS\([ED](.)\)\s*(.*$)',
+                                  line)
+                tracedata.event = int(m_type.group(2))
+                tracedata.ion_mode = m_type.group(3)
+                if m_type.group(4) != 'TIC':
+                    tracedata.mode = 'mrm'
+                    m_mrm = re.match(r'm/z\ ([\d\.]+)>([\d\.]+)',
+                                     m_type.group(4))
+                    tracedata.precursor = float(m_mrm.group(1))
+                    tracedata.product = float(m_mrm.group(2))
+                while not line.startswith('R.Time'):
+                    line = fp.readline()
+                line = fp.readline()
+                times, resps = [], []
+                while line != '\n':
+                    row = line.split(delim)
+                    times.append(row[0])
+                    resps.append(row[1])
+                    line = fp.readline()
+                tracedata.times = numpy.array(times, dtype=float)
+                tracedata.responses = numpy.array(resps, dtype=int)
+                for trace in traces:
+                    if trace.same_channel(tracedata):
+                        tracedata.channel += 1
+                traces.append(tracedata)
+            line = fp.readline()
+    return name, id, traces
+
+
+def check_identical(path):
+    name, id, traces = legacy_parse(path)
+    file = File(path)
+    assert (file.name, file.id) == (name, id)
+    assert len(file.traces) == len(traces)
+    for new, old in zip(file.traces, traces):
+        for key in ['mode', 'ion_mode', 'event', 'channel',
+                    'precursor', 'product']:
+            assert getattr(new, key) == getattr(old, key), key
+        for key in ['times', 'responses']:
+            a, b = getattr(new, key), getattr(old, key)
+            assert a.dtype == b.dtype and numpy.array_equal(a, b), key
+
+
+def main(events=34, channels=2, points=3000, repeats=3):
+    fd, path = tempfile.mkstemp(suffix='.txt')
+    os.close(fd)
+    try:
+        write_file(path, events, channels, points)
+        check_identical(path)
+        size = os.path.getsize(path) / 1e6
+        legacy = min(timeit.repeat(lambda: legacy_parse(path),
+                                   number=1, repeat=repeats))
+        bulk = min(timeit.repeat(lambda: File(path).load(),
+                                 number=1, repeat=repeats))
+        print('file: {:.1f} MB, {} traces of {} points'.format(
+            size, events * channels + 1, points))
+        print('legacy: {:.3f} s\nbulk:   {:.3f} s\nspeedup: {:.1f}x'.format(
+            legacy, bulk, legacy / bulk))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:5]])
@@ -0,0 +1,168 @@
+"""Benchmark suite for parsing, filtering, peak detection with
+integration, and rendering with the Agg backend.
+
+Each case runs on generated files of several sizes and the best of
+'repeats' runs is reported. Results can be saved as a baseline and later
+runs compared against it, flagging cases slower by more than a threshold.
+
+Usage: python -m bench.run [--sizes small,medium] [--cases parse,render]
+                           [--repeats N]
+                           [--save <json>] [--compare <json>]
+                           [--threshold 0.2]
+"""
+import argparse
+import collections
+import json
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+from bench.generate import write_file
+
+# events, channels per precursor and points per trace
+SIZES = collections.OrderedDict([
+    ('small', (10, 2, 1000)),
+    ('medium', (34, 2, 3000)),
+    ('large', (68, 4, 6000)),
+])
+
+
+def bench_parse(path, memo):
+    from chrom.file import File
+    return lambda: File(path).load()
+
+
+def bench_filter(path, memo):
+    from chrom.filter import Filter
+    file = _loaded(path, memo)
+
+    def run():
+        file.reset_index()
+        Filter('event=[3,4,5],channel=0').filter(file)
+    return run
+
+
+def bench_peaks(path, memo):
+    import chrom.integrate
+    import chrom.peaks
+    from chrom.transform import Pipeline, Smooth
+    file = _loaded(path, memo)
+    pipeline = Pipeline([Smooth(2)])
+
+    def run():
+        file.reset_index()
+        peaks = chrom.peaks.detect(file, file.traces, pipeline=pipeline)
+        positions = [t.index for t in file.traces]
+        chrom.integrate.integrate(pipeline.apply(file, positions),
+                                  peaks['trace'], peaks['start'],
+                                  peaks['end'])
+    return run
+
+
+def bench_render(path, memo):
+    import matplotlib
+    matplotlib.use('Agg')
+    import shiz2plot
+    from chrom.file import File
+    output = os.path.join(os.path.dirname(path), 'render.png')
+    files = {}
+
+    def run():
+        File.FILE_ID = 0
+        shiz2plot.main(['-S', '-T', '--no-cache', '--dpi', '150',
+                        '-o', output, path], files=files)
+    return run
+
+
+CASES = collections.OrderedDict([
+    ('parse', bench_parse),
+    ('filter', bench_filter),
+    ('peaks', bench_peaks),
+    ('render', bench_render),
+])
+
+
+def _loaded(path, memo):
+    from chrom.file import File
+    if path not in memo:
+        memo[path] = File(path)
+        memo[path].load()
+    return memo[path]
+
+
+def run(sizes, cases, repeats):
+    """Returns the best time in seconds of each case and size."""
+    results = collections.OrderedDict()
+    tmp = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            path = os.path.join(tmp, size + '.txt')
+            write_file(path, *SIZES[size])
+            memo = {}
+            for case in cases:
+                bench = CASES[case](path, memo)
+                bench()  # Warm up imports and caches
+                key = '{}/{}'.format(case, size)
+                results[key] = min(timeit.repeat(bench, number=1,
+                                                 repeat=repeats))
+                print('{:<16} {:>10.4f}'.format(key, results[key]))
+    finally:
+        shutil.rmtree(tmp)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Prints the change of each case against 'baseline'.
+    Returns the cases slower by more than 'threshold', a fraction."""
+    regressions = []
+    print('{:<16} {:>10} {:>10} {:>8}'.format(
+        'case', 'base (s)', 'now (s)', 'change'))
+    for key, now in results.items():
+        if key not in baseline:
+            continue
+        change = now / baseline[key] - 1.0
+        flag = ''
+        if change > threshold:
+            regressions.append(key)
+            flag = ' regression'
+        print('{:<16} {:>10.4f} {:>10.4f} {:>+8.1%}{}'.format(
+            key, baseline[key], now, change, flag))
+    return regressions
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='small,medium',
+                        help='Comma separated, of {}.'.format(
+                            ', '.join(SIZES)))
+    parser.add_argument('--cases', default=','.join(CASES),
+                        help='Comma separated, of {}.'.format(
+                            ', '.join(CASES)))
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--save', metavar='<json>',
+                        help='Save the results as a baseline.')
+    parser.add_argument('--compare', metavar='<json>',
+                        help='Compare the results with a baseline.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed slow down, as a fraction.')
+    args = parser.parse_args(args)
+
+    results = run(args.sizes.split(','), args.cases.split(','),
+                  args.repeats)
+
+    if args.save is not None:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=1)
+    if args.compare is not None:
+        with open(args.compare, 'r') as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.threshold)
+        if len(regressions) > 0:
+            print('regressions: {}'.format(', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
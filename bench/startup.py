@@ -0,0 +1,80 @@
+"""Times interpreter startup and imports of shiz2plot commands.
+
+Each command is run in a fresh interpreter with -X importtime. Reports the
+wall time and the cumulative import time of the heaviest top level
+packages.
+
+Usage: python -m bench.startup [repeats]
+"""
+import collections
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.generate import write_file
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'shiz2plot.py')
+
+
+def commands(path, report, output):
+    return collections.OrderedDict([
+        ('listkeys', ['--listkeys', 'options']),
+        ('report', ['-S', '-T', '--no-cache', '--report', report,
+                    path + '::integrate=true']),
+        ('render', ['-S', '-T', '--no-cache', '-o', output, path]),
+    ])
+
+
+def import_times(stderr: str):
+    """Cumulative import time in seconds of each top level package."""
+    totals = collections.Counter()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented, only the outermost are counted
+        name = name[1:]
+        if cumulative.strip().isdigit() and not name.startswith(' '):
+            totals[name.split('.')[0]] += int(cumulative) / 1e6
+    return totals
+
+
+def run(args, repeats):
+    best, totals = None, None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', SCRIPT] + args,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True, env=dict(os.environ, MPLBACKEND='Agg'))
+        elapsed = time.perf_counter() - start
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr)
+        if best is None or elapsed < best:
+            best, totals = elapsed, import_times(result.stderr)
+    return best, totals
+
+
+def main(repeats=3):
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'data.txt')
+    write_file(path, 34, 2, 3000)
+    try:
+        print('{:>10} {:>9}  {}'.format(
+            'command', 'wall (s)', 'heaviest imports (s)'))
+        for name, args in commands(path, os.path.join(tmp, 'report.tsv'),
+                                   os.path.join(tmp, 'out.png')).items():
+            wall, totals = run(args, repeats)
+            print('{:>10} {:>9.3f}  {}'.format(name, wall, ', '.join(
+                '{} {:.3f}'.format(k, v) for k, v in totals.most_common(4))))
+    finally:
+        for name in os.listdir(tmp):
+            os.remove(os.path.join(tmp, name))
+        os.rmdir(tmp)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:2]])
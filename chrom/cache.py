@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy
+
+from chrom.file import Trace
+from chrom.store import TraceStore
+
+
+def default_cache_dir():
+    root = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(root, 'shiz2plot')
+
+
+class Cache(object):
+    """Stores parsed files as directories of memory-mappable arrays.
+    Entries are keyed by path, checked against the file size and mtime and
+    evicted least recently used first once 'max_size' bytes is exceeded.
+    Only the rows of loaded traces are stored, the rest are read from the
+    file when needed. The cache is only a speed up, if it cannot be used
+    files are parsed as without one."""
+    VERSION = 4
+
+    def __init__(self, path=None, max_size=512e6):
+        self.path = default_cache_dir() if path is None else path
+        self.max_size = max_size
+        # Stat and number of loaded traces of each entry read or written
+        self.saved = {}
+        try:
+            os.makedirs(self.path, exist_ok=True)
+        except OSError:
+            self.path = None
+
+    def entry(self, path: str):
+        key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+        return os.path.join(self.path, key)
+
+    def _stat(self, path: str):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def read(self, file):
+        """Fills 'file' from its cache entry.
+        Returns False if there is no valid entry."""
+        if self.path is None:
+            return False
+        entry = self.entry(file.path)
+        try:
+            with open(os.path.join(entry, 'info.json')) as fp:
+                info = json.load(fp)
+            if info['version'] != Cache.VERSION or \
+                    info['path'] != file.path or \
+                    info['stat'] != self._stat(file.path):
+                return False
+            offsets, loaded, blocks = [
+                numpy.load(os.path.join(entry, name + '.npy'))
+                for name in ['offsets', 'loaded', 'blocks']]
+            # Complete entries are mapped, partial ones copied below
+            times, responses = [
+                numpy.load(os.path.join(entry, name + '.npy'),
+                           mmap_mode='r' if loaded.all() else None)
+                for name in ['times', 'responses']]
+        except (OSError, ValueError, KeyError):
+            return False
+
+        file.name, file.id = info['name'], info['id']
+        file.stat = tuple(info['stat'])
+        file.nl, file.delim = [info[key].encode('latin-1')
+                               for key in ['nl', 'delim']]
+        file.blocks = blocks
+        columns = info['columns']
+        columns['traceid'] = Trace._gen_uids(len(offsets) - 1)
+        if not loaded.all():
+            # Only loaded rows are stored, spread them over the full arrays
+            store = TraceStore(times, responses, offsets, columns)
+            rows, _ = store.rows(numpy.flatnonzero(loaded))
+            full = [numpy.empty(offsets[-1], dtype=times.dtype),
+                    numpy.empty(offsets[-1], dtype=responses.dtype)]
+            full[0][rows], full[1][rows] = times, responses
+            times, responses = full
+        file.set_store(TraceStore(times, responses, offsets, columns,
+                                  loaded=loaded, loader=file._read))
+        self.saved[file.path] = (file.stat, int(loaded.sum()))
+
+        # Mark as recently used
+        try:
+            os.utime(os.path.join(entry, 'info.json'))
+        except OSError:
+            pass
+        return True
+
+    def write(self, file):
+        """Stores the rows of the loaded traces of 'file', unless its entry
+        already holds them, then evicts old entries.
+        Returns False if the entry could not be written."""
+        if self.path is None:
+            return False
+        store = file.store
+        count = int(store.loaded.sum())
+        if self.saved.get(file.path) == (file.stat, count):
+            return True
+        info = {
+            'version': Cache.VERSION,
+            'path': file.path,
+            'stat': list(file.stat),
+            'name': file.name,
+            'id': file.id,
+            'nl': file.nl.decode('latin-1'),
+            'delim': file.delim.decode('latin-1'),
+            'columns': {key: column.tolist()
+                        for key, column in store.columns.items()
+                        if key != 'traceid'},
+        }
+        rows = slice(None) if store.loaded.all() else \
+            store.rows(numpy.flatnonzero(store.loaded))[0]
+
+        # Write to a temporary directory and move into place
+        entry = self.entry(file.path)
+        try:
+            tmp = tempfile.mkdtemp(dir=self.path, prefix='.tmp')
+        except OSError:
+            return False
+        try:
+            numpy.save(os.path.join(tmp, 'times.npy'), store.times[rows])
+            numpy.save(os.path.join(tmp, 'responses.npy'),
+                       store.responses[rows])
+            numpy.save(os.path.join(tmp, 'offsets.npy'), store.offsets)
+            numpy.save(os.path.join(tmp, 'loaded.npy'), store.loaded)
+            numpy.save(os.path.join(tmp, 'blocks.npy'), file.blocks)
+            with open(os.path.join(tmp, 'info.json'), 'w') as fp:
+                json.dump(info, fp)
+
+            shutil.rmtree(entry, ignore_errors=True)
+            os.replace(tmp, entry)
+        except OSError:
+            # Another process may have just written the entry
+            shutil.rmtree(tmp, ignore_errors=True)
+            return os.path.isdir(entry)
+        self.saved[file.path] = (file.stat, count)
+
+        self.evict()
+        return True
+
+    def evict(self):
+        """Removes the least recently used entries until under max_size."""
+        entries = []
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        for name in names:
+            entry = os.path.join(self.path, name)
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f))
+                           for f in os.listdir(entry))
+                used = os.path.getmtime(os.path.join(entry, 'info.json'))
+            except OSError:
+                continue
+            entries.append((used, size, entry))
+
+        total = sum(e[1] for e in entries)
+        for used, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
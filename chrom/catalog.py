@@ -0,0 +1,123 @@
+import mmap
+import os
+import sqlite3
+
+from chrom.cache import default_cache_dir
+from chrom.file import _dialect, _scan
+from util.valueparse import Range, is_collection
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,
+    name TEXT, id TEXT);
+CREATE TABLE IF NOT EXISTS traces (
+    path TEXT, mode TEXT, ion_mode TEXT, event INTEGER, channel INTEGER,
+    precursor REAL, product REAL);
+CREATE INDEX IF NOT EXISTS traces_path ON traces (path);
+"""
+# Filter keys answered by the catalog, others are checked once opened
+FILE_KEYS = ['path', 'name', 'id']
+TRACE_KEYS = ['mode', 'ion_mode', 'event', 'channel', 'precursor', 'product']
+
+
+def scan(path: str):
+    """Reads the sample information and chromatogram headers of an export,
+    skipping its data rows. Returns the name, id and a list of headers."""
+    name, id, headers = '', -1, []
+    with open(path, 'rb') as fp, \
+            mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        nl, delim = _dialect(data)
+        for section in _scan(data, nl, delim):
+            if section[0] == 'sample':
+                name = section[1].get('Sample Name', name)
+                id = section[1].get('Sample ID', id)
+            else:
+                headers.append(section[1])
+    return name, id, headers
+
+
+def _clause(column: str, value, params: list):
+    """Sql matching 'column' to a filter value, adding its parameters."""
+    values = list(value) if is_collection(value) else [value]
+    exact = [v for v in values if not isinstance(v, Range)]
+    terms = ['{} IN ({})'.format(column, ', '.join('?' * len(exact)))]
+    params.extend(exact)
+    for v in values:
+        if isinstance(v, Range):
+            terms.append('{} BETWEEN ? AND ?'.format(column))
+            params.extend([v.lo, v.hi])
+    return '(' + ' OR '.join(terms) + ')'
+
+
+class Catalog(object):
+    """Sqlite index of the samples and chromatograms of exports.
+    Files are only scanned again once their size or mtime changes."""
+
+    def __init__(self, path=None):
+        self.path = os.path.join(default_cache_dir(), 'catalog.sqlite') \
+            if path is None else path
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                    exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.db.close()
+
+    def update(self, paths: list):
+        """Scans the files in 'paths' that are new or changed.
+        Files that are not exports are stored without chromatograms."""
+        known = {row[0]: tuple(row[1:]) for row in self.db.execute(
+            'SELECT path, size, mtime_ns FROM files')}
+        with self.db:
+            for path in paths:
+                path = os.path.abspath(path)
+                stat = os.stat(path)
+                if known.get(path) == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                try:
+                    name, id, headers = scan(path)
+                except (AttributeError, ValueError):
+                    name, id, headers = None, None, []
+                self.db.execute('DELETE FROM traces WHERE path = ?', (path,))
+                self.db.execute(
+                    'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                    (path, stat.st_size, stat.st_mtime_ns, name, id))
+                self.db.executemany(
+                    'INSERT INTO traces VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(path,) + tuple(h[k] for k in TRACE_KEYS)
+                     for h in headers])
+
+    def select(self, filter, paths=None):
+        """Returns the sorted paths of files with at least one chromatogram
+        passing the chrom.filter.Filter 'filter', limited to 'paths'.
+        Keys such as traceid and fileid can only be checked once the file
+        is opened, so they are ignored."""
+        clauses, params = [], []
+        for key, value in filter.get().items():
+            if key in FILE_KEYS:
+                column = 'files.' + key
+            elif key in TRACE_KEYS:
+                column = 'traces.' + key
+            else:
+                continue
+            clauses.append(_clause(column, value, params))
+        # Each compound is an and of its criteria, any compound may match
+        if hasattr(filter, 'compound'):
+            terms = ['(' + ' AND '.join(
+                _clause('traces.' + key, value, params)
+                for key, value in criteria.items()) + ')'
+                for criteria in filter.compounds() if len(criteria) > 0]
+            clauses.append('(' + (' OR '.join(terms) or '0') + ')')
+
+        query = 'SELECT DISTINCT files.path FROM files JOIN traces ' \
+                'ON traces.path = files.path'
+        if len(clauses) > 0:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        found = set(row[0] for row in self.db.execute(query, params))
+        if paths is not None:
+            found &= set(os.path.abspath(p) for p in paths)
+        return sorted(found)
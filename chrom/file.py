@@ -1,31 +1,64 @@
+import copy
+import mmap
+import multiprocessing
+import os
 import re
-import os.path
+import types
 import numpy
 
+from chrom.store import COLUMNS, TraceStore
+from util.timing import stage
+
+
+def _column(key: str):
+    """A property reading and writing item 'index' of a store column."""
+    def get(self):
+        return self.store.columns[key].item(self.index)
+
+    def set(self, value):
+        self.store.columns[key][self.index] = value
+
+    return property(get, set)
+
 
 class Trace(object):
+    """A view of trace 'index' in a TraceStore."""
     TRACE_ID = 0
+    __slots__ = ['store', 'index']
 
-    def _gen_uid(self):
-        id = Trace.TRACE_ID
-        Trace.TRACE_ID += 1
-        return id
+    @staticmethod
+    def _gen_uids(n: int):
+        ids = numpy.arange(Trace.TRACE_ID, Trace.TRACE_ID + n)
+        Trace.TRACE_ID += n
+        return ids
 
-    def __init__(self, mode='tic', ion_mode='+',
-                 event=0, channel=0, precursor=0.0, product=0.0,
-                 times=numpy.zeros(0, dtype=float),
-                 responses=numpy.zeros(0, dtype=int)):
-        self.mode = mode
-        self.ion_mode = ion_mode
-        self.event = event
-        self.channel = channel
-        self.precursor = precursor
-        self.product = product
-        self.times = times
-        self.responses = responses
-
-        # Gen unique ID
-        self.traceid = self._gen_uid()
+    def __init__(self, store: TraceStore, index: int):
+        self.store = store
+        self.index = index
+
+    mode = _column('mode')
+    ion_mode = _column('ion_mode')
+    event = _column('event')
+    channel = _column('channel')
+    precursor = _column('precursor')
+    product = _column('product')
+    traceid = _column('traceid')
+
+    @property
+    def loaded(self):
+        return self.store.loaded[self.index]
+
+    @property
+    def times(self):
+        if not self.loaded:
+            self.store.load([self.index])
+        return self.store.times[self.store.span(self.index)]
+
+    @property
+    def responses(self):
+        if not self.loaded:
+            self.store.load([self.index])
+        return self.store.responses[self.store.span(self.index)]
 
     def same_channel(self, other):
         return self.precursor > 0.0 and self.precursor == other.precursor
@@ -42,6 +75,10 @@ class Trace(object):
 
 class File(object):
     FILE_ID = 0
+    # Optional chrom.cache.Cache used by every new File
+    CACHE = None
+    INDEX_KEYS = ['mode', 'ion_mode', 'event', 'channel',
+                  'precursor', 'product', 'traceid']
 
     def _gen_uid(self):
         id = File.FILE_ID
@@ -57,64 +94,358 @@ class File(object):
         self.id = -1
         self.fileid = self._gen_uid()
 
-        self.parse(path)
+        with stage('parse', file=self.path) as record:
+            if File.CACHE is None:
+                self.parse(path)
+            elif not File.CACHE.read(self):
+                # Cached once traces are loaded, see save_files
+                self.parse(path)
+            record['traces'] = len(self.traces)
 
     def parse(self, path: str):
+        """Indexes the sample info and chromatogram headers.
+        Data rows are only read once a trace is loaded."""
         if self.format != 'shimadzu':
             raise TypeError('Uknown format {}!'.format(self.format))
         self.name = ""
         self.id = -1
-        self.traces = []
-
-        with open(self.path) as fp:
-            line = fp.readline()  # Skip header
-            line = fp.readline()
-            delim = re.match('.*(.)LabSolutions\n', line).group(1)
-            while line:
-                if line == '[Sample Information]\n':
-                    # Extract sample info
-                    while line != '\n':
-                        info = line.split(delim)
-                        if info[0] == 'Sample Name':
-                            self.name = info[1].rstrip()
-                        elif info[0] == 'Sample ID':
-                            self.id = info[1].rstrip()
-                        line = fp.readline()
-                elif line == '[MS Chromatogram]\n':
-                    # Extract trace information
-                    tracedata = Trace()
-                    line = fp.readline().rstrip()
-                    m_type = re.match('m/z.(\d+)-(\d+)MS\([ED](.)\)\s*(.*$)',
-                                      line)
-                    if m_type is None:
-                        print(line)
-                    tracedata.event = int(m_type.group(2))
-                    tracedata.ion_mode = m_type.group(3)
-                    # Check if MRM or TIC
-                    if m_type.group(4) != 'TIC':
-                        tracedata.mode = 'mrm'
-                        m_mrm = re.match('m/z\ ([\d\.]+)>([\d\.]+)',
-                                         m_type.group(4))
-                        tracedata.precursor = float(m_mrm.group(1))
-                        tracedata.product = float(m_mrm.group(2))
-                    # Skip unwanted
-                    while not line.startswith('R.Time'):
-                        line = fp.readline()
-                    line = fp.readline()
-                    # Read data
-                    times, resps = [], []
-                    while line != '\n':
-                        row = line.split(delim)
-                        times.append(row[0])
-                        resps.append(row[1])
-                        line = fp.readline()
-
-                    tracedata.times = numpy.array(times, dtype=float)
-                    tracedata.responses = numpy.array(resps, dtype=int)
-
-                    # Calculate channel
-                    for trace in self.traces:
-                        if trace.same_channel(tracedata):
-                            tracedata.channel += 1
-                    self.traces.append(tracedata)
-                line = fp.readline()
+        columns = {key: [] for key in COLUMNS}
+        blocks, rows = [], []
+
+        with open(self.path, 'rb') as fp, \
+                mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            stat = os.fstat(fp.fileno())
+            self.stat = (stat.st_size, stat.st_mtime_ns)
+            self.nl, self.delim = _dialect(data)
+
+            for section in _scan(data, self.nl, self.delim):
+                if section[0] == 'sample':
+                    self.name = section[1].get('Sample Name', self.name)
+                    self.id = section[1].get('Sample ID', self.id)
+                    continue
+                header, start, end = section[1:]
+                for key, value in header.items():
+                    columns[key].append(value)
+                blocks.append((start, end))
+                rows.append(data[start:end].count(self.nl) + 1
+                            if end > start else 0)
+
+        columns['traceid'] = Trace._gen_uids(len(blocks))
+        self.blocks = numpy.array(blocks, dtype=numpy.int64).reshape(-1, 2)
+        offsets = numpy.cumsum([0] + rows)
+        self.set_store(TraceStore(
+            numpy.empty(offsets[-1], dtype=float),
+            numpy.empty(offsets[-1], dtype=int),
+            offsets, columns, loaded=numpy.zeros(len(blocks), dtype=bool),
+            loader=self._read))
+
+    def set_store(self, store: TraceStore):
+        """Replaces the traces of the file with views of 'store'."""
+        self.store = store
+        self.traces = [Trace(store, i) for i in range(len(store))]
+        self.reset_index()
+
+    def reset_index(self):
+        """Drops the indexes, memoized selections and derived results.
+        Needed whenever the traces or their ids change."""
+        self._indexes = {}
+        self.selections = {}
+        # Results computed from the traces, see chrom.peaks.detect
+        self.derived = {}
+
+    def index(self, key: str):
+        """Returns a dict mapping each value of the trace attribute 'key'
+        to the sorted positions of the traces holding it."""
+        if key not in self._indexes:
+            values, inverse = numpy.unique(self.store.columns[key],
+                                           return_inverse=True)
+            order = numpy.argsort(inverse, kind='stable')
+            splits = numpy.cumsum(numpy.bincount(inverse))[:-1]
+            self._indexes[key] = dict(zip(values.tolist(),
+                                          numpy.split(order, splits)))
+        return self._indexes[key]
+
+    def sorted_index(self, key: str):
+        """Returns the sorted values of the trace attribute 'key' and the
+        positions of the traces holding them, for range queries."""
+        if (key, 'sorted') not in self._indexes:
+            order = numpy.argsort(self.store.columns[key], kind='stable')
+            self._indexes[key, 'sorted'] = (self.store.columns[key][order],
+                                            order)
+        return self._indexes[key, 'sorted']
+
+    def load(self, traces=None):
+        """Reads the data rows of 'traces', or of every trace if None."""
+        self.store.load(None if traces is None
+                        else [t.index for t in traces])
+
+    def _read(self, positions):
+        """Parses the data blocks at 'positions' into the store.
+        Blocks are read in file order with a single open."""
+        with stage('load', file=self.path, traces=len(positions)), \
+                open(self.path, 'rb') as fp:
+            stat = os.fstat(fp.fileno())
+            if (stat.st_size, stat.st_mtime_ns) != self.stat:
+                raise IOError('File {} changed since it was parsed!'.format(
+                    self.path))
+            for i in sorted(positions):
+                start, end = self.blocks[i]
+                fp.seek(start)
+                values = _parse_block(fp.read(end - start),
+                                      self.delim, self.nl)
+                span = self.store.span(i)
+                self.store.times[span] = values[:, 0]
+                self.store.responses[span] = values[:, 1]
+
+
+# Bytes of data kept by a load_files memo, least recently used files first
+MEMO_SIZE = 512e6
+
+
+def load_files(paths: list, jobs=1, memo: dict = None, filters=None):
+    """Returns a File for each path, in order.
+    With jobs > 1 the files are parsed in a pool of processes. Workers load
+    the traces passing the chrom.filter.Filters of each path in 'filters',
+    if given, otherwise every trace. If a cache is set, workers only fill
+    it and the main process maps the cached arrays, otherwise the loaded
+    Files are sent back.
+    memo -> optional dict of Files by absolute path. Files in it are reused
+    while unchanged on disk, and newly parsed files are added. Files not
+    used recently are dropped once it holds more than MEMO_SIZE bytes.
+    A path is only parsed once, repeats and reused files are shallow copies
+    sharing data and derived results. File ids are always assigned in
+    input order."""
+    memo = {} if memo is None else memo
+    keys = [os.path.abspath(path) for path in paths]
+    missing, selected = {}, {}
+    for i, (path, key) in enumerate(zip(paths, keys)):
+        if key not in missing and not _is_current(memo.get(key)):
+            missing[key] = path
+        if filters is not None:
+            selected.setdefault(key, []).append(filters[i])
+    missing = list(missing.values())
+
+    first_id = File.FILE_ID
+    if jobs <= 1 or len(missing) < 2:
+        parsed = [File(path) for path in missing]
+    else:
+        with multiprocessing.Pool(min(jobs, len(missing)),
+                                  initializer=_init_worker,
+                                  initargs=(File.CACHE,)) as pool:
+            parsed = pool.starmap(_parse_file, [
+                (path, selected.get(os.path.abspath(path)))
+                for path in missing])
+        for i, (path, file) in enumerate(zip(missing, parsed)):
+            if file is None:
+                parsed[i] = File(path)
+            else:
+                file.store.columns['traceid'][:] = Trace._gen_uids(
+                    len(file.traces))
+                file.reset_index()
+    fresh = {file.path: file for file in parsed}
+    memo.update(fresh)
+
+    # Ids follow the order of 'paths', not the order of parsing
+    File.FILE_ID = first_id
+    files = []
+    for key in keys:
+        file = fresh.pop(key, None) or copy.copy(memo[key])
+        file.fileid = file._gen_uid()
+        files.append(file)
+    _trim_memo(memo, keys)
+    return files
+
+
+def _trim_memo(memo: dict, used: list):
+    """Marks 'used' as most recently used, then drops the least recently
+    used files of 'memo' until under MEMO_SIZE."""
+    used = set(used)
+    for key in used:
+        if key in memo:
+            memo[key] = memo.pop(key)
+    size = sum(f.store.times.nbytes + f.store.responses.nbytes
+               for f in memo.values())
+    for key in list(memo):
+        if size <= MEMO_SIZE or key in used:
+            break
+        file = memo.pop(key)
+        size -= file.store.times.nbytes + file.store.responses.nbytes
+
+
+def save_files(files: list):
+    """Writes the loaded traces of 'files' to the cache, if any. Called once
+    traces are loaded, entries already holding them are not rewritten."""
+    if File.CACHE is None:
+        return
+    for file in files:
+        File.CACHE.write(file)
+
+
+def _is_current(file):
+    """True if 'file' is a File whose path is unchanged since parsing."""
+    if file is None:
+        return False
+    try:
+        stat = os.stat(file.path)
+    except OSError:
+        return False
+    return (stat.st_size, stat.st_mtime_ns) == file.stat
+
+
+def _init_worker(cache):
+    File.CACHE = cache
+
+
+def _parse_file(path: str, filters=None):
+    """Parses 'path' and loads the traces passing any of 'filters', or
+    every trace if None."""
+    file = File(path)
+    if filters is None or any(hasattr(f, 'traceid') for f in filters):
+        # Trace ids differ from those of the main process
+        file.load()
+    else:
+        positions = []
+        for filter in filters:
+            # So do file ids, checked again in the main process
+            filter = copy.copy(filter)
+            filter.__dict__.pop('fileid', None)
+            positions.extend(filter.select(file))
+        file.load([file.traces[i] for i in sorted(set(positions))])
+    if File.CACHE is None:
+        return file
+    save_files([file])
+    return None
+
+
+class Sample(object):
+    """The sample information of one export in a streamed file."""
+
+    def __init__(self, path: str, name="", id=-1):
+        self.path = path
+        self.name = name
+        self.id = id
+
+
+def iter_traces(path: str, filter=None):
+    """Yields a (Sample, Trace) pair for each chromatogram in 'path'.
+    Each trace owns its own store and the file is memory mapped, so memory
+    is bounded by the largest chromatogram rather than the file. Data rows
+    are only parsed for traces passing the chrom.filter.Filter 'filter'.
+    Files holding several concatenated exports are supported, channels are
+    numbered separately for each sample."""
+    sample = Sample(os.path.abspath(path))
+    with open(path, 'rb') as fp, \
+            mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        nl, delim = _dialect(data)
+        for section in _scan(data, nl, delim):
+            if section[0] == 'sample':
+                sample = Sample(sample.path,
+                                section[1].get('Sample Name', ""),
+                                section[1].get('Sample ID', -1))
+                continue
+            header, start, end = section[1:]
+            header['traceid'] = Trace._gen_uids(1)[0]
+            if filter is not None and not filter.accepts(
+                    sample, types.SimpleNamespace(**header)):
+                continue
+            values = _parse_block(data[start:end], delim, nl)
+            store = TraceStore.from_arrays(
+                [values[:, 0]], [values[:, 1].astype(int)],
+                {key: [value] for key, value in header.items()})
+            yield sample, Trace(store, 0)
+
+
+def _dialect(data):
+    """Returns the line ending and delimiter, taken from the header."""
+    start = data.find(b'\n') + 1
+    nl = b'\r\n' if data[start - 2:start] == b'\r\n' else b'\n'
+    delim = re.match(b'.*(.)LabSolutions\r?\n',
+                     data[start:data.find(b'\n', start) + 1]).group(1)
+    return nl, delim
+
+
+def _scan(data, nl: bytes, delim: bytes):
+    """Walks the sections of an export in file order.
+    Yields ('sample', info) for each sample information block, info being a
+    dict of its fields, and ('chromatogram', header, start, end) for each
+    chromatogram, start:end being the byte range of its data rows."""
+    sample = nl + b'[Sample Information]' + nl
+    section = nl + b'[MS Chromatogram]' + nl
+    next_sample, pos = data.find(sample), data.find(section)
+    channels = {}
+    while next_sample != -1 or pos != -1:
+        # Extract sample info
+        if next_sample != -1 and (pos == -1 or next_sample < pos):
+            end = _find_block_end(data, next_sample + len(nl), nl)
+            info = {}
+            for line in data[next_sample + len(nl):end].split(nl):
+                fields = line.decode().split(delim.decode())
+                if len(fields) > 1:
+                    info[fields[0]] = fields[1].rstrip()
+            channels = {}
+            yield 'sample', info
+            next_sample = data.find(sample, end)
+            continue
+
+        # Extract trace information
+        pos += len(section)
+        header = _parse_header(data[pos:data.find(nl, pos)].rstrip())
+        # Skip unwanted
+        start = data.find(nl, data.find(nl + b'R.Time', pos) + len(nl))
+        end = _find_block_end(data, start, nl)
+        start += len(nl)
+
+        # Calculate channel, counting earlier traces per precursor
+        header['channel'] = 0
+        if header['precursor'] > 0.0:
+            header['channel'] = channels.get(header['precursor'], 0)
+            channels[header['precursor']] = header['channel'] + 1
+        yield 'chromatogram', header, start, max(start, end)
+        pos = data.find(section, end)
+
+
+def _find_block_end(data: bytes, pos: int, nl: bytes):
+    """Returns the index of the blank line that ends the block containing
+    'pos', or the end of 'data'."""
+    end = data.find(nl + nl, pos)
+    if end == -1:
+        end = len(data)
+        while data[end - len(nl):end] == nl:
+            end -= len(nl)
+    return end
+
+
+def _parse_header(line: bytes):
+    """Returns the metadata in a chromatogram header line."""
+    m_type = re.match(b'm/z.(\\d+)-(\\d+)MS\\([ED](.)\\)\\s*(.*$)', line)
+    if m_type is None:
+        raise ValueError('Unable to parse chromatogram header {}!'.format(
+            line.decode()))
+    header = {'mode': 'tic', 'ion_mode': m_type.group(3).decode(),
+              'event': int(m_type.group(2)),
+              'precursor': 0.0, 'product': 0.0}
+    # Check if MRM or TIC
+    if m_type.group(4) != b'TIC':
+        header['mode'] = 'mrm'
+        m_mrm = re.match(b'm/z\\ ([\\d\\.]+)>([\\d\\.]+)', m_type.group(4))
+        header['precursor'] = float(m_mrm.group(1))
+        header['product'] = float(m_mrm.group(2))
+    return header
+
+
+def _parse_block(block: bytes, delim: bytes, nl: bytes):
+    """Converts the rows of a data block in a single call.
+    Returns a float array of shape (rows, columns)."""
+    if len(block) == 0:
+        return numpy.zeros((0, 2), dtype=float)
+    first = block.find(nl)
+    ncols = block.count(delim, 0, len(block) if first == -1 else first) + 1
+    # Any whitespace is a separator for fromstring
+    if not delim.isspace():
+        block = block.replace(delim, b' ')
+    values = numpy.fromstring(block, sep=' ')
+    nrows = block.count(nl) + 1
+    if values.size != nrows * ncols:
+        raise ValueError('Malformed data block, expected {} values, read {}!'
+                         .format(nrows * ncols, values.size))
+    return values.reshape(nrows, ncols)
@@ -1,16 +1,26 @@
+import functools
+
+import numpy
+
 from chrom.file import File, Trace
 from util.kvparser import KeyValParser
-from util.valueparse import is_or_in_either
+from util.lookups import load_library
+from util.timing import stage
+from util.valueparse import Range, is_collection, is_or_in_either, \
+    parse_range
 
 
 class Filter(KeyValParser):
     VALID_KEYS = {
         "mode": "(str) detection mode. \'tic\' or \'mrm\'.",
         "ion_mode": "(str) ionisation mode. \'+\' or \'-\'.",
-        "event": "(int,str) event id or name.",
+        "event": "(int,str) event id or compound name, see --library.",
+        "compound": "(str) compound name, matched by event, or transition if"
+                    " its event is blank. <name>+IS adds its standard.",
         "channel": "(int) channel id.",
-        "precursor": "(float) precursor ion m/z.",
-        "product": "(float) product ion m/z.",
+        "precursor": "(float) precursor ion m/z, or a range 400..520, "
+                     "or a tolerance 412.9~0.01 or 412.9~10ppm.",
+        "product": "(float) product ion m/z, or a range or tolerance.",
         "traceid": "(int) unique trace id.",
 
         "path": "(str) absolute path to file.",
@@ -18,31 +28,10 @@ class Filter(KeyValParser):
         "id": "(int) the id of the sample.",
         "fileid": "(int) unique file id.",
     }
-    LOOKUP = {
-        "event": {
-            "PFBA": 1, "MPFBA": 2,
-            "PFPeA": 3, "M5PFPeA": 4,
-            "PFBS": 5, "M3PFBS": 6,
-            "PFHxA": 7, "M5PFHxA": 8,
-            "PFPeS": 9,
-            "PFHpA": 10, "M4PFHpA": 11,
-            "PFHxS": 12, "M3PFHxS": 13,
-            "PFOA": 14, "M8PFOA": 15,
-            "PFHpS": 16,
-            "PFNA": 17, "M9PFNA": 18,
-            "PFOS": 19, "M8PFOS": 20,
-            "PFDA": 21, "M6PFDA": 22,
-            "PFNS": 23,
-            "PFUnA": 24, "M7PFUnA": 25,
-            "PFDS": 26,
-            "PFDoA": 27, "MPFDoA": 28,
-            "PFTrDA": 29,
-            "PFDoS": 30,
-            "PFTeDA": 31, "M2PFTeDA": 32,
-            "PFHxDA": 33,
-            "PFODA": 34
-        }
-    }
+    # Keys accepting a range or tolerance
+    RANGE_KEYS = ["precursor", "product"]
+    # Path of the compound library resolving event names, None for default
+    LIBRARY = None
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -50,15 +39,38 @@ class Filter(KeyValParser):
     def _key_is_valid(self, key):
         return key in Filter.VALID_KEYS.keys()
 
-    # def _lookup_key(self, key, vals):
-    #     if key in Filter.LOOKUP.keys():
-    #         print(key)
-    #         new_vals = []
-    #         for v in [vals]:
-    #             new_vals.append(getattr(Filter.LOOKUP[key], v, v))
-    #         vals = new_vals
-    #     print(vals)
-    #     return vals
+    def _lookup_key(self, key, vals):
+        """Converts m/z ranges and tolerances, such as 400..520, 412.9~0.01
+        or 412.9~10ppm, to a Range and compound names to their event.
+        Names such as PFOA+IS expand to the compound and its standard.
+        Unknown names are kept, matching no traces."""
+        if is_collection(vals):
+            converted = []
+            for v in vals:
+                v = self._lookup_key(key, v)
+                converted.extend(v if isinstance(v, list) else [v])
+            return type(vals)(converted)
+        if not isinstance(vals, str):
+            return vals
+        if key in Filter.RANGE_KEYS:
+            return parse_range(vals) or vals
+        if key in ["event", "compound"]:
+            library = load_library(Filter.LIBRARY)
+            names = library.expand(vals)
+            if key == "event":
+                names = [n if library.event(n) is None else library.event(n)
+                         for n in names]
+            return names if len(names) > 1 else names[0]
+        return vals
+
+    def compounds(self):
+        """The criteria of each compound selected, see Library.criteria."""
+        if not hasattr(self, "compound"):
+            return []
+        names = self.compound if is_collection(self.compound) \
+            else [self.compound]
+        library = load_library(Filter.LIBRARY)
+        return [library.criteria(str(name)) for name in names]
 
     def _check_key(self, key, obj):
         if hasattr(obj, key) and is_or_in_either(getattr(self, key),
@@ -72,13 +84,87 @@ class Filter(KeyValParser):
                 if not is_or_in_either(getattr(self, key),
                                        getattr(trace, key)):
                     return False
+        if hasattr(self, "compound"):
+            return any(len(c) > 0 and all(
+                is_or_in_either(v, getattr(trace, k)) for k, v in c.items())
+                for c in self.compounds())
         return True
 
-    def filter(self, file: File):
+    def accepts(self, file, trace):
+        """Checks a single trace of 'file' without using any index."""
         for key in self.get():
-            if hasattr(file, key):
-                if not is_or_in_either(getattr(self, key),
-                                       getattr(file, key)):
-                    return []
+            if hasattr(file, key) and not self._check_key(key, file):
+                return False
+        return self._filter_trace(trace)
 
-        return [t for t in file.traces if self._filter_trace(t)]
+    def key(self):
+        """A hashable form of the current filter values."""
+        return tuple(sorted((k, tuple(v) if isinstance(v, list) else v)
+                            for k, v in self.get().items()))
+
+    def select(self, file: File):
+        """Returns the sorted positions of the traces in 'file' that pass.
+        File keys are checked on every call, as copies of a file share its
+        traces but not its ids. Trace keys are resolved by intersecting the
+        file's indexes and the result is memoized on the file."""
+        for k, vals in self.get().items():
+            if hasattr(file, k) and not is_or_in_either(vals,
+                                                        getattr(file, k)):
+                return numpy.arange(0)
+        key = tuple(item for item in self.key() if not hasattr(file, item[0]))
+        compounds = self.compounds()
+        if len(compounds) > 0:
+            # The library may change between calls
+            key += (repr(compounds),)
+        if key in file.selections:
+            return file.selections[key]
+
+        # Only the matching positions are touched, never every trace
+        selection = None
+        for k, vals in self.get().items():
+            if k in File.INDEX_KEYS:
+                matches = self._positions(file, k, vals)
+            elif k == "compound":
+                matches = numpy.arange(0)
+                for criteria in compounds:
+                    if len(criteria) > 0:
+                        matches = numpy.union1d(matches, functools.reduce(
+                            numpy.intersect1d,
+                            [self._positions(file, ck, cv)
+                             for ck, cv in criteria.items()]))
+            else:
+                continue
+            selection = matches if selection is None else \
+                numpy.intersect1d(selection, matches, assume_unique=True)
+            if len(selection) == 0:
+                break
+        if selection is None:
+            selection = numpy.arange(len(file.traces))
+
+        file.selections[key] = selection
+        return selection
+
+    def _positions(self, file: File, key: str, vals):
+        """Sorted positions of the traces whose 'key' is or is in 'vals'."""
+        index = file.index(key)
+        if not isinstance(vals, (list, tuple)):
+            vals = [vals]
+        matches = [index[v] for v in vals
+                   if not isinstance(v, Range) and v in index]
+        # Ranges are found by binary search of the sorted values
+        for v in vals:
+            if isinstance(v, Range):
+                values, order = file.sorted_index(key)
+                matches.append(order[
+                    numpy.searchsorted(values, v.lo, 'left'):
+                    numpy.searchsorted(values, v.hi, 'right')])
+        return numpy.unique(numpy.concatenate(matches)) \
+            if len(matches) > 0 else numpy.arange(0)
+
+    def filter(self, file: File):
+        with stage('filter', file=file.path) as record:
+            traces = [file.traces[i] for i in self.select(file)]
+            # Only the selected traces are read from disk
+            file.load(traces)
+            record['traces'] = len(traces)
+        return traces
@@ -0,0 +1,85 @@
+import numpy
+
+from chrom.store import TraceStore
+
+AREA_DTYPE = numpy.dtype([
+    ('trace', int),  # position of the trace in its store
+    ('start', float),
+    ('end', float),
+    ('area', float),
+])
+
+
+def cumulative_trapezoid(store: TraceStore, responses=None):
+    """Cumulative trapezoid integral of every trace in one flat array.
+    Item i holds the area from the first row of its trace up to row i."""
+    y = numpy.asarray(store.responses if responses is None else responses,
+                      dtype=float)
+    areas = numpy.zeros(y.size)
+    if y.size < 2:
+        return areas
+    segments = numpy.diff(store.times) * (y[1:] + y[:-1]) / 2.0
+    lengths = store.lengths()
+    filled = lengths > 0
+    # No segment joins the last row of a trace to the next trace
+    last = store.offsets[1:][filled] - 1
+    segments[last[last < segments.size]] = 0.0
+    numpy.cumsum(segments, out=areas[1:])
+    areas -= numpy.repeat(areas[store.offsets[:-1][filled]], lengths[filled])
+    return areas
+
+
+def integrate(store: TraceStore, traces, starts, ends,
+              responses=None, cumulative=None):
+    """Integrates the windows starts:ends (times) of the store positions
+    'traces'. The cumulative integral is computed once, see
+    cumulative_trapezoid, and each window costs two lookups.
+    Windows are clipped to their trace. Returns an AREA_DTYPE array."""
+    traces = numpy.asarray(traces, dtype=int)
+    areas = numpy.zeros(traces.size, dtype=AREA_DTYPE)
+    areas['trace'] = traces
+    areas['start'], areas['end'] = starts, ends
+    lengths = store.lengths()[traces]
+    valid = lengths > 1
+    if not numpy.any(valid):
+        return areas
+
+    y = numpy.asarray(store.responses if responses is None else responses,
+                      dtype=float)
+    if cumulative is None:
+        cumulative = cumulative_trapezoid(store, y)
+
+    # Times made increasing across all traces, for a single search
+    t = store.times
+    counts = store.lengths()
+    filled = counts > 0
+    owner = numpy.repeat(numpy.arange(len(store))[filled], counts[filled])
+    relative = t - numpy.repeat(t[store.offsets[:-1][filled]], counts[filled])
+    width = relative.max() + 1.0
+    keys = relative + owner * width
+
+    traces, lengths = traces[valid], lengths[valid]
+    first = store.offsets[traces]
+    last = first + lengths - 1
+    ends, starts = [
+        _area_at(t, y, cumulative, keys, traces * width - t[first],
+                 first, last, times)
+        for times in [areas['end'][valid], areas['start'][valid]]]
+    areas['area'][valid] = ends - starts
+    return areas
+
+
+def _area_at(t, y, cumulative, keys, shift, first, last, times):
+    """Cumulative area up to 'times' for traces spanning rows first:last.
+    shift converts each time into a search key."""
+    times = numpy.clip(times, t[first], t[last])
+    rows = numpy.searchsorted(keys, times + shift, side='right') - 1
+    rows = numpy.clip(rows, first, last - 1)
+
+    # Exact area of the linear interpolant from the row to the time
+    dt = times - t[rows]
+    step = t[rows + 1] - t[rows]
+    fraction = numpy.divide(dt, step, out=numpy.zeros_like(dt),
+                            where=step != 0.0)
+    ytime = y[rows] + fraction * (y[rows + 1] - y[rows])
+    return cumulative[rows] + dt * (y[rows] + ytime) / 2.0
@@ -4,16 +4,30 @@ from util.kvparser import KeyValParser
 class Options(KeyValParser):
     VALID_KEYS = {
         "axis": "(int, int) x, y position of the plot.",
+        "baseline": "(str, float, float) subtract an asymmetric least"
+                    " squares baseline, (als, lam, p), or a rolling"
+                    " minimum, (min, window).",
         "colorby": "(str) attribute used to determine color.",
+        "collect": "(bool) draw traces sharing axes and plotkws as a single"
+                   " line collection, best used with decimate.",
         "scale": "(float, float) scale the plot data.",
         "shift": "(float, float) shift the plot data.",
         "xlim": "(float, float) define x limits for the data.",
         "ylim": "(float, float) define y limits for the data.",
-        "integrate": "(bool) intergrate peaks.",
+        "decimate": "(bool) draw at most the minimum and maximum response"
+                    " of each pixel column.",
+        "integrate": "(bool, list) intergrate detected peaks, or the"
+                     " windows start1, end1, ...",
         "legend": "legend entries for the plot.",
         "name": "(str) name of the plot.",
+        "normalize": "(bool) divide responses by their maximum.",
         "peaklabels": "(list) labels for peaks, from left.",
-        "smooth": "(int) smooth data with \'int\' order."
+        "peaks": "(float, int) minimum relative prominence and width of"
+                 " detected peaks.",
+        "smooth": "(int, int) smooth data with a 2 * order + 1 point"
+                  " Savitzky-Golay filter, order at least 1, of polynomial"
+                  " order 2 or the second value, at most 2 * order - 1."
+                  " smooth=(n, 0) gives a moving average."
     }
     """Stores per-file options for plotting."""
     def __init__(self, *args, **kwargs):
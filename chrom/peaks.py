@@ -0,0 +1,101 @@
+import numpy
+
+from chrom.store import TraceStore
+from util.timing import stage
+
+PEAK_DTYPE = numpy.dtype([
+    ('trace', int),  # position of the trace in its store
+    ('apex', int),  # rows within the trace
+    ('left', int),
+    ('right', int),
+    ('time', float),  # time of the apex
+    ('start', float),  # interpolated boundary times
+    ('end', float),
+    ('height', float),
+    ('prominence', float),
+])
+
+
+def find_peaks(store: TraceStore, responses=None,
+               prominence=0.1, width=3, rel_height=0.95):
+    """Finds the peaks of every trace in 'store' with one scipy call.
+    responses -> optional flat array replacing store.responses.
+    prominence -> minimum prominence, relative to the trace maximum.
+    width -> minimum width in rows.
+    rel_height -> height at which the boundaries are taken, relative to the
+                  prominence.
+    Returns a PEAK_DTYPE array ordered by trace and apex."""
+    import scipy.signal
+
+    y = numpy.asarray(store.responses if responses is None else responses,
+                      dtype=float)
+    if y.size == 0:
+        return numpy.zeros(0, dtype=PEAK_DTYPE)
+    offsets, lengths = store.offsets, store.lengths()
+
+    # Per trace thresholds
+    filled = lengths > 0
+    maxima = numpy.zeros(len(store))
+    maxima[filled] = numpy.maximum.reduceat(y, offsets[:-1][filled])
+    minimum = numpy.repeat(prominence * maxima, lengths)
+
+    # Traces are split by a wall higher than any value, bounding the bases
+    # of every peak to its own trace
+    splits = offsets[1:-1]
+    padded = numpy.insert(y, splits, y.max() + 1.0)
+    minimum = numpy.insert(minimum, splits, numpy.inf)
+    source = numpy.insert(numpy.arange(y.size), splits, -1)
+
+    apex, props = scipy.signal.find_peaks(
+        padded, prominence=(minimum, None), width=width,
+        rel_height=rel_height)
+    keep = source[apex] >= 0
+    apex = apex[keep]
+    props = {k: v[keep] for k, v in props.items()}
+
+    rows = source[apex]
+    trace = numpy.searchsorted(offsets, rows, side='right') - 1
+    lower = source[numpy.floor(props['left_ips']).astype(int)]
+    upper = source[numpy.floor(props['right_ips']).astype(int)]
+    upper_fraction = props['right_ips'] % 1.0
+
+    peaks = numpy.zeros(apex.size, dtype=PEAK_DTYPE)
+    peaks['trace'] = trace
+    peaks['apex'] = rows - offsets[trace]
+    peaks['left'] = lower - offsets[trace]
+    peaks['right'] = upper + (upper_fraction > 0.0) - offsets[trace]
+    peaks['time'] = store.times[rows]
+    peaks['start'] = _interp(store.times, lower, props['left_ips'] % 1.0)
+    peaks['end'] = _interp(store.times, upper, upper_fraction)
+    peaks['height'] = y[rows]
+    peaks['prominence'] = props['prominences']
+    return peaks
+
+
+def _interp(times, rows, fraction):
+    """Times a 'fraction' of the way from each row to the next."""
+    following = numpy.minimum(rows + 1, times.size - 1)
+    return times[rows] + fraction * (times[following] - times[rows])
+
+
+def detect(file, traces: list, pipeline=None, **kwargs):
+    """Returns the peaks of 'traces' in 'file', see find_peaks.
+    pipeline -> optional chrom.transform.Pipeline applied before searching.
+    Results are cached on the file for each trace, pipeline and set of
+    arguments, traces without a cached result are searched in one batch."""
+    cache = file.derived.setdefault(
+        ('peaks', None if pipeline is None else pipeline.key) +
+        tuple(sorted(kwargs.items())), {})
+    missing = sorted(set(t.index for t in traces if t.index not in cache))
+    if len(missing) > 0:
+        store = file.store.take(missing) if pipeline is None \
+            else pipeline.apply(file, missing)
+        with stage('peaks', file=file.path, traces=len(missing)):
+            found = find_peaks(store, **kwargs)
+        counts = numpy.bincount(found['trace'], minlength=len(missing))
+        found['trace'] = numpy.asarray(missing)[found['trace']]
+        for i, peaks in zip(missing,
+                            numpy.split(found, numpy.cumsum(counts)[:-1])):
+            cache[i] = peaks
+    return numpy.concatenate([numpy.zeros(0, dtype=PEAK_DTYPE)] +
+                             [cache[t.index] for t in traces])
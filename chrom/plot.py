@@ -1,5 +1,8 @@
 import numpy
-import scipy.integrate
+
+import chrom.integrate
+import chrom.peaks
+import chrom.transform
 
 from chrom.file import File, Trace
 from chrom.options import Options
@@ -7,21 +10,27 @@ from chrom.filter import Filter
 from chrom.keywords import Keywords
 
 from util.colors import base16_colors
+from util.timing import stage
+from util.valueparse import is_collection
 
 
 class Plot(object):
     def __init__(self, string: str, default_filter: Filter,
                  default_options: Options,
-                 default_poltkws: Keywords):
-        """Format for string is <filename>[:<filter>[:<options>[:<plotkw>]]]"""
+                 default_poltkws: Keywords, file: File = None):
+        """Format for string is <filename>[:<filter>[:<options>[:<plotkw>]]]
+        An already parsed 'file' is used instead of <filename>."""
 
         self.filter = default_filter
         self.options = default_options
         self.plotkws = default_poltkws
+        self.file = file
 
         self.parse(string)
 
         self.handles = []
+        # Artists added to the axes, see clear
+        self.artists = []
         # if colorby not in ['channel', 'event', 'file']:
         #     raise ValueError("Plot: Invalid colorby value " + colorby)
 
@@ -32,7 +41,8 @@ class Plot(object):
         if len(tokens) > 4:
             raise TypeError("Plot.parse: To many tokens recieved!")
 
-        self.file = File(tokens[0])
+        if self.file is None:
+            self.file = File(tokens[0])
 
         if len(tokens) > 1:
             self.filter.parse(tokens[1])
@@ -61,70 +71,132 @@ class Plot(object):
                 self.options.colorby))
             return "#000000"
 
-    def integrate_peak(self, trace: Trace):
-        result = scipy.integrate.trapz(trace.responses,
-                                       trace.times)
-        return int(result)
+    def integrate(self):
+        """Integrates the selected traces, see chrom.integrate.integrate.
+        Windows are the detected peaks, or the (start, end) time pairs
+        given to the 'integrate' option. Trace positions in the returned
+        array refer to self.file.store."""
+        traces = self.filter.filter(self.file)
+        positions = numpy.array([t.index for t in traces], dtype=int)
+        if is_collection(self.options.integrate):
+            windows = numpy.reshape(self.options.integrate, (-1, 2))
+            owners = numpy.repeat(positions, len(windows))
+            starts = numpy.tile(windows[:, 0], len(positions))
+            ends = numpy.tile(windows[:, 1], len(positions))
+        else:
+            peaks = self.find_peaks(traces)
+            owners, starts, ends = peaks['trace'], peaks['start'], peaks['end']
+
+        # Integrate every window in one pass over the selected traces
+        store = self.pipeline().apply(self.file, positions)
+        with stage('integrate', file=self.file.path, traces=len(positions)):
+            areas = chrom.integrate.integrate(
+                store, numpy.searchsorted(positions, owners), starts, ends)
+        areas['trace'] = owners
+        return areas
+
+    def pipeline(self):
+        """The processing applied to traces before they are plotted,
+        searched for peaks or integrated, see chrom.transform.Pipeline."""
+        filters = []
+        if hasattr(self.options, 'smooth'):
+            smooth = self.options.smooth
+            filters.append(chrom.transform.Smooth(*smooth)
+                           if is_collection(smooth)
+                           else chrom.transform.Smooth(smooth))
+        if hasattr(self.options, 'baseline'):
+            baseline = self.options.baseline
+            filters.append(chrom.transform.Baseline(*baseline)
+                           if is_collection(baseline)
+                           else chrom.transform.Baseline(baseline))
+        return chrom.transform.Pipeline(
+            filters, normalize=getattr(self.options, 'normalize', False),
+            shift=getattr(self.options, 'shift', (0.0, 0.0)),
+            scale=getattr(self.options, 'scale', (1.0, 1.0)))
+
+    def find_peaks(self, traces: list):
+        """Returns the cached peaks of 'traces', see chrom.peaks.detect."""
+        kwargs = {}
+        if hasattr(self.options, 'peaks'):
+            kwargs['prominence'], kwargs['width'] = self.options.peaks
+        return chrom.peaks.detect(self.file, traces,
+                                  pipeline=self.pipeline(), **kwargs)
 
     def label_peaks(self, ax, labels, by='event'):
         # if only using certain filtered 'by' params
         groups = getattr(self.filter, by) if \
-                 hasattr(self.filter, by) else range(1, len(labels))
+                 hasattr(self.filter, by) else range(1, len(labels) + 1)
+        if not is_collection(groups):
+            groups = [groups]
+        if not is_collection(labels):
+            labels = [labels]
+
+        peaks = self.find_peaks(self.filter.filter(self.file))
+        values = self.file.store.columns[by][peaks['trace']]
 
         for label, group in zip(labels, groups):
             xy = (0, 0)
-            for trace in self.filter.filter(self.file):
-                if getattr(trace, by) == group:
-                    peak = trace.detect_peak()
-                    if peak[1] > xy[1]:
-                        xy = peak
-            ax.annotate(label, xy=xy, xytext=(0, 5),
-                        xycoords='data', textcoords='offset points',
-                        va='bottom', ha='center')
-
-    def shift_and_scale(self, trace: Trace):
-            if not hasattr(self, 'scale') and not hasattr(self, 'shift'):
-                return trace.times, trace.responses
-
-            # Create a new trace object and copy data into it
-            times, responses = trace.times[:], trace.responses[:]
-            # Apply shift and scale operations
-            if hasattr(self, 'shift'):
-                numpy.add(times, self.shift[0], out=times)
-                numpy.add(responses, self.shift[1], out=responses)
-            if hasattr(self, 'scale'):
-                numpy.multiply(times, self.scale[0],
-                               out=times)
-                numpy.multiply(responses, self.scale[1],
-                               out=responses)
-            return times, responses
-
-    def plot(self, axes, hstack=False):
+            matches = peaks[values == group]
+            if matches.size > 0:
+                peak = matches[numpy.argmax(matches['height'])]
+                xy = (peak['time'], peak['height'])
+            self.artists.append(ax.annotate(
+                label, xy=xy, xytext=(0, 5),
+                xycoords='data', textcoords='offset points',
+                va='bottom', ha='center'))
+
+    def plot(self, axes, hstack=False, groups=None):
+        """Plots the filtered traces on their axes.
+        With the 'collect' option traces are added to 'groups', a LineGroups
+        drawn by the caller, or to one drawn at the end of this call."""
         plotkws = self.plotkws.get().copy()
         ax = self.assign_axis(axes, hstack)
-        # Filter traces and plot them
-        for i, trace in enumerate(self.filter.filter(self.file)):
+        # Filter and process traces, then plot them
+        traces = self.filter.filter(self.file)
+        store = self.pipeline().apply(self.file, [t.index for t in traces])
+        if getattr(self.options, 'decimate', False) and store.times.size > 0:
+            xlim = self.options.xlim if hasattr(self.options, 'xlim') \
+                else (store.times.min(), store.times.max())
+            store = chrom.transform.decimate(store, xlim,
+                                             max(int(ax.bbox.width), 1))
+
+        # Adjust limits is nessecary
+        if len(traces) > 0 and hasattr(self.options, 'xlim'):
+            ax.set_xlim(self.options.xlim)
+        if len(traces) > 0 and hasattr(self.options, 'ylim'):
+            ax.set_ylim(self.options.ylim)
+
+        collect = getattr(self.options, 'collect', False)
+        if collect:
+            local = groups is None
+            groups = LineGroups() if local else groups
+            segments = numpy.split(
+                numpy.column_stack([store.times, store.responses]),
+                store.offsets[1:-1]) if len(traces) > 0 else []
+        for i, trace in enumerate(traces):
             # Create color for trace if needed
             if not hasattr(self.plotkws, 'color'):
                 plotkws['color'] = self.get_color(trace)
 
-            # Adjust limits is nessecary
-            if hasattr(self.options, 'xlim'):
-                ax.set_xlim(self.options.xlim)
-            if hasattr(self.options, 'ylim'):
-                ax.set_ylim(self.options.ylim)
             # Plot the traces and store handles
-            handle, = ax.plot(*self.shift_and_scale(trace),
-                              **plotkws)
+            if collect:
+                handle = groups.add(ax, plotkws, segments[i])
+            else:
+                handle, = ax.plot(store.times[store.span(i)],
+                                  store.responses[store.span(i)], **plotkws)
+                self.artists.append(handle)
             self.handles.append(handle)
+        if collect and local:
+            self.artists.extend(groups.draw())
 
         # Add the names
         if hasattr(self.options, 'name'):
-            ax.annotate(self.file.name if self.options.name is None
-                        else self.options.name,
-                        xy=(1, 1), xycoords='axes fraction',
-                        xytext=(-5, -5), textcoords='offset points',
-                        fontsize=10, ha='right', va='top')
+            self.artists.append(ax.annotate(
+                self.file.name if self.options.name is None
+                else self.options.name,
+                xy=(1, 1), xycoords='axes fraction',
+                xytext=(-5, -5), textcoords='offset points',
+                fontsize=10, ha='right', va='top'))
 
         # Label peaks
         if hasattr(self.options, 'peaklabels'):
@@ -132,10 +204,65 @@ class Plot(object):
 
         # Intergrate
         if hasattr(self.options, 'integrate'):
-            for trace in self.filter.filter(self.file):
-                label = self.integrate_peak(trace)
-                xpos = trace.detect_peak()[0]
+            areas = self.integrate()
+            xpos = (areas['start'] + areas['end']) / 2.0
+            if not is_collection(self.options.integrate):
+                xpos = self.find_peaks(
+                    self.filter.filter(self.file))['time']
+            for area, x in zip(areas['area'], xpos):
+                self.artists.append(ax.annotate(
+                    int(area), xy=(x, 0), xycoords='data',
+                    xytext=(0, 0), textcoords='offset points',
+                    fontsize=8, va='bottom', ha='center'))
+
+    def clear(self):
+        """Removes the artists added by plot, except shared collections."""
+        for artist in self.artists:
+            artist.remove()
+        self.artists = []
+        self.handles = []
+
+
+class LineGroups(object):
+    """Traces headed for the same axes with the same keywords, drawn as one
+    LineCollection each. Colours may differ between traces. Groups with
+    keywords only lines support, such as marker or drawstyle, are drawn as
+    separate lines."""
+
+    def __init__(self):
+        self.groups = {}
+
+    def add(self, ax, plotkws: dict, segment):
+        """Adds a (n, 2) array of points to the group of 'ax' and 'plotkws'.
+        Returns a line, not added to any axes, for use as a legend handle."""
+        import matplotlib.lines
+
+        plotkws = plotkws.copy()
+        color = plotkws.pop('color', None)
+        key = (id(ax), repr(sorted(plotkws.items())))
+        if key not in self.groups:
+            self.groups[key] = (ax, plotkws, [], [])
+        self.groups[key][2].append(segment)
+        self.groups[key][3].append(color)
+        return matplotlib.lines.Line2D([], [], color=color, **plotkws)
+
+    def draw(self):
+        """Adds a collection, or the lines, of each group to its axes.
+        Returns the artists added."""
+        import matplotlib.collections
 
-                ax.annotate(label, xy=(xpos, 0), xycoords='data',
-                            xytext=(0, 0), textcoords='offset points',
-                            fontsize=8, va='bottom', ha='center')
+        artists = []
+        for ax, plotkws, segments, colors in self.groups.values():
+            try:
+                collection = matplotlib.collections.LineCollection(
+                    segments, colors=colors, **plotkws)
+            except AttributeError:
+                for segment, color in zip(segments, colors):
+                    artists.extend(ax.plot(segment[:, 0], segment[:, 1],
+                                           color=color, **plotkws))
+                continue
+            ax.add_collection(collection)
+            ax.autoscale_view()
+            artists.append(collection)
+        self.groups = {}
+        return artists
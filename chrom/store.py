@@ -0,0 +1,80 @@
+import numpy
+
+# Per-trace metadata columns and their types
+COLUMNS = {
+    'mode': str,
+    'ion_mode': str,
+    'event': int,
+    'channel': int,
+    'precursor': float,
+    'product': float,
+    'traceid': int,
+}
+
+
+class TraceStore(object):
+    """Times and responses of many traces in two contiguous arrays.
+    Trace i spans offsets[i]:offsets[i + 1] and its metadata is item i of
+    each array in columns. If a loader is given it is called with the
+    positions of traces whose rows have not been read yet."""
+
+    def __init__(self, times, responses, offsets, columns: dict,
+                 loaded=None, loader=None):
+        self.times = times
+        self.responses = responses
+        self.offsets = numpy.asarray(offsets, dtype=numpy.int64)
+        self.columns = {key: numpy.asarray(columns[key], dtype=dtype)
+                        for key, dtype in COLUMNS.items()}
+        self.loaded = numpy.ones(len(self), dtype=bool) if loaded is None \
+            else loaded
+        self.loader = loader
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def from_arrays(cls, times: list, responses: list, columns: dict):
+        """Builds a store by concatenating per trace arrays."""
+        offsets = numpy.cumsum([0] + [len(t) for t in times])
+        return cls(numpy.concatenate([numpy.zeros(0, dtype=float)] + times),
+                   numpy.concatenate([numpy.zeros(0, dtype=int)] + responses),
+                   offsets, columns)
+
+    def span(self, i: int):
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def lengths(self):
+        return numpy.diff(self.offsets)
+
+    def load(self, positions=None):
+        """Reads the rows of 'positions', or of every trace if None."""
+        if positions is None:
+            missing = numpy.flatnonzero(~self.loaded)
+        else:
+            positions = numpy.asarray(positions, dtype=int)
+            missing = numpy.unique(positions[~self.loaded[positions]])
+        if missing.size > 0:
+            self.loader(missing)
+            self.loaded[missing] = True
+
+    def rows(self, positions):
+        """Returns the rows of the traces at 'positions', concatenated, and
+        the offsets of each trace within them."""
+        positions = numpy.asarray(positions, dtype=int)
+        lengths = self.lengths()[positions]
+        offsets = numpy.concatenate([[0], numpy.cumsum(lengths)])
+        rows = numpy.arange(offsets[-1]) - numpy.repeat(offsets[:-1], lengths)
+        rows += numpy.repeat(self.offsets[positions], lengths)
+        return rows, offsets
+
+    def take(self, positions, times=None, responses=None):
+        """Returns a new store holding copies of the traces at 'positions'.
+        The copies are gathered in one pass into contiguous arrays, unless
+        replacement 'times' or 'responses' are given."""
+        positions = numpy.asarray(positions, dtype=int)
+        self.load(positions)
+        rows, offsets = self.rows(positions)
+        return TraceStore(self.times[rows] if times is None else times,
+                          self.responses[rows] if responses is None
+                          else responses, offsets,
+                          {k: v[positions] for k, v in self.columns.items()})
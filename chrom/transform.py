@@ -0,0 +1,241 @@
+import numpy
+
+from chrom.store import TraceStore
+from util.timing import stage
+
+
+def padded(store: TraceStore, values=None):
+    """Returns the traces of 'store' as rows of a 2d array.
+    Rows are extended with their last value, as numpy 'edge' padding.
+    Empty traces are filled with zeros."""
+    values = store.responses if values is None else values
+    lengths = store.lengths()
+    width = max(int(lengths.max(initial=0)), 1)
+    columns = numpy.minimum(numpy.arange(width),
+                            numpy.maximum(lengths - 1, 0)[:, None])
+    # The appended zero keeps rows of a trailing empty trace in bounds
+    values = numpy.append(numpy.asarray(values, dtype=float), 0.0)
+    matrix = values[store.offsets[:-1, None] + columns]
+    matrix[lengths == 0] = 0.0
+    return matrix
+
+
+def unpadded(store: TraceStore, matrix):
+    """Inverse of padded, returns the flat values of each row."""
+    mask = numpy.arange(matrix.shape[1]) < store.lengths()[:, None]
+    return matrix[mask]
+
+
+def savgol(store: TraceStore, window: int, polyorder: int, values=None):
+    """Savitzky-Golay filter of every trace in 'store' in a single call.
+    A polyorder of 0 gives a moving average. The polyorder is kept below
+    window - 1, at which the filter would return its input unchanged. Trace
+    ends are extended with their end values. Returns a flat array matching
+    store.responses."""
+    import scipy.signal
+
+    if len(store) == 0:
+        return numpy.zeros(0)
+    matrix = scipy.signal.savgol_filter(padded(store, values), window,
+                                        max(min(polyorder, window - 2), 0),
+                                        axis=1, mode='nearest')
+    return unpadded(store, matrix)
+
+
+def als_baseline(store: TraceStore, values, lam=1e6, p=0.01, iterations=10):
+    """Asymmetric least squares baseline of every trace in 'store'.
+    The second difference penalty of all traces forms one pentadiagonal
+    system, with no terms joining neighbouring traces, solved each
+    iteration by a banded Cholesky decomposition in linear time.
+    lam -> smoothness of the baseline.
+    p -> weight of points above the baseline, in (0, 1)."""
+    import scipy.linalg
+
+    y = numpy.asarray(values, dtype=float)
+    if y.size < 3:
+        return y.copy()
+    owner = numpy.repeat(numpy.arange(len(store)), store.lengths())
+    # Rows of the second difference operator that stay inside a trace
+    rows = lam * (owner[:-2] == owner[2:])
+
+    # Upper banded form of lam * D'D
+    penalty = numpy.zeros((3, y.size))
+    penalty[0, 2:] += rows
+    penalty[1, 1:-1] -= 2.0 * rows
+    penalty[1, 2:] -= 2.0 * rows
+    penalty[2, :-2] += rows
+    penalty[2, 1:-1] += 4.0 * rows
+    penalty[2, 2:] += rows
+
+    weights = numpy.ones(y.size)
+    for _ in range(iterations):
+        band = penalty.copy()
+        band[2] += weights
+        z = scipy.linalg.solveh_banded(band, weights * y,
+                                       overwrite_ab=True, check_finite=False)
+        weights = numpy.where(y > z, p, 1.0 - p)
+    return z
+
+
+def rolling_min_baseline(store: TraceStore, values, window=50):
+    """Rolling minimum baseline of every trace in 'store', smoothed by a
+    moving average of the same width. Computed for all traces at once."""
+    import scipy.ndimage
+
+    if len(store) == 0:
+        return numpy.zeros(0)
+    matrix = scipy.ndimage.minimum_filter1d(
+        padded(store, values), int(window), axis=1, mode='nearest')
+    matrix = scipy.ndimage.uniform_filter1d(
+        matrix, int(window), axis=1, mode='nearest')
+    return unpadded(store, matrix)
+
+
+def decimate(store: TraceStore, xlim, columns: int):
+    """Reduces each trace to at most two points per pixel column, those
+    with the minimum and maximum response, so no peak is lost when drawn.
+    xlim -> (start, end) times spanned by the 'columns' pixel columns.
+    Rows outside xlim fall into one column at each side. The first and last
+    rows of every trace are kept. Returns a new TraceStore."""
+    t, y = store.times, store.responses
+    if t.size == 0:
+        return store
+    lengths = store.lengths()
+    owner = numpy.repeat(numpy.arange(len(store)), lengths)
+    width = (xlim[1] - xlim[0]) / float(columns)
+    column = numpy.clip(numpy.floor((t - xlim[0]) / width), -1, columns)
+
+    # Times increase within a trace, so each column is one run of rows
+    keys = owner * (columns + 2) + column.astype(numpy.int64) + 1
+    starts = numpy.flatnonzero(numpy.diff(keys, prepend=-1))
+    counts = numpy.diff(numpy.append(starts, keys.size))
+
+    keep = numpy.zeros(t.size, dtype=bool)
+    for reduce in [numpy.minimum, numpy.maximum]:
+        extreme = numpy.repeat(reduce.reduceat(y, starts), counts)
+        # The first row in each run equal to its extreme
+        rows = numpy.flatnonzero(y == extreme)
+        group = numpy.searchsorted(starts, rows, side='right')
+        keep[rows[numpy.diff(group, prepend=0) > 0]] = True
+    filled = lengths > 0
+    keep[store.offsets[:-1][filled]] = True
+    keep[store.offsets[1:][filled] - 1] = True
+
+    offsets = numpy.concatenate(
+        [[0], numpy.cumsum(numpy.bincount(owner[keep], minlength=len(store)))])
+    return TraceStore(t[keep], y[keep], offsets, store.columns)
+
+
+class Smooth(object):
+    """Savitzky-Golay filter step of 2 * order + 1 points, order being at
+    least 1. The polyorder is lowered to window - 2 if needed, so a window
+    of 3 points is a moving average."""
+
+    def __init__(self, order: int, polyorder=2):
+        if int(order) < 1:
+            raise ValueError('Smooth order must be at least 1, not {}!'.format(
+                order))
+        self.window = 2 * int(order) + 1
+        self.polyorder = max(min(int(polyorder), self.window - 2), 0)
+        self.key = ('smooth', self.window, self.polyorder)
+
+    def __call__(self, store: TraceStore, values):
+        return savgol(store, self.window, self.polyorder, values)
+
+
+class Baseline(object):
+    """Baseline subtraction step.
+    method 'als' -> asymmetric least squares, params lam and p.
+    method 'min' -> rolling minimum, param window in rows."""
+    METHODS = {'als': als_baseline, 'min': rolling_min_baseline}
+
+    def __init__(self, method='als', *params):
+        if method not in Baseline.METHODS:
+            raise ValueError('Unknown baseline method {}!'.format(method))
+        self.method = method
+        self.params = tuple(float(x) for x in params)
+        self.key = ('baseline', self.method, self.params)
+
+    def __call__(self, store: TraceStore, values):
+        return values - Baseline.METHODS[self.method](
+            store, values, *self.params)
+
+
+class Pipeline(object):
+    """Processing of trace data before it is drawn, searched or integrated.
+    Filter steps, such as Smooth or Baseline, run first and their results
+    are cached on the file for each trace. The remaining steps are affine:
+    responses are normalised to their maximum, then both axes are shifted
+    and scaled.
+    These are fused into one multiply-add over a single new buffer, so the
+    file's data is never modified."""
+
+    def __init__(self, filters=None, normalize=False,
+                 shift=(0.0, 0.0), scale=(1.0, 1.0)):
+        self.filters = [] if filters is None else filters
+        self.normalize = normalize
+        self.shift = tuple(float(x) for x in shift)
+        self.scale = tuple(float(x) for x in scale)
+        self.key = tuple(f.key for f in self.filters) + \
+            (('affine', self.normalize, self.shift, self.scale),)
+
+    def filtered(self, file, positions: list, steps=None):
+        """Returns the responses of the traces at 'positions' of file.store
+        after the first 'steps' filters, all by default. Results for each
+        prefix of the filters are cached per trace and uncached traces are
+        processed in one batch."""
+        steps = len(self.filters) if steps is None else steps
+        if steps == 0:
+            return [file.traces[p].responses for p in positions]
+        cache = file.derived.setdefault(
+            ('filtered',) + tuple(f.key for f in self.filters[:steps]), {})
+        missing = sorted(set(p for p in positions if p not in cache))
+        if len(missing) > 0:
+            values = self.filtered(file, missing, steps - 1)
+            store = file.store.take(missing, responses=numpy.concatenate(
+                [numpy.zeros(0)] + values))
+            with stage(self.filters[steps - 1].key[0], file=file.path,
+                       traces=len(missing)):
+                values = self.filters[steps - 1](store, store.responses)
+            for p, span in zip(missing, numpy.split(values,
+                                                    store.offsets[1:-1])):
+                cache[p] = span
+        return [cache[p] for p in positions]
+
+    def apply(self, file, positions: list):
+        """Returns a TraceStore of the processed traces at 'positions'."""
+        positions = numpy.asarray(positions, dtype=int)
+        file.store.load(positions)
+        rows, offsets = file.store.rows(positions)
+        lengths = numpy.diff(offsets)
+
+        times = file.store.times[rows]
+        if self.shift[0] != 0.0 or self.scale[0] != 1.0:
+            times += self.shift[0]
+            times *= self.scale[0]
+
+        if len(self.filters) > 0:
+            responses = numpy.concatenate(
+                [numpy.zeros(0)] + self.filtered(file, positions))
+        else:
+            responses = file.store.responses[rows]
+
+        # y' = (y / max + shift) * scale = y * a + b
+        a = numpy.full(len(positions), self.scale[1])
+        if self.normalize:
+            filled = lengths > 0
+            maxima = numpy.ones(len(positions))
+            maxima[filled] = numpy.maximum.reduceat(responses,
+                                                    offsets[:-1][filled])
+            a /= numpy.where(maxima != 0.0, maxima, 1.0)
+        b = self.shift[1] * self.scale[1]
+        if numpy.any(a != 1.0) or b != 0.0:
+            # Raw responses are integers, the first step writes a new buffer
+            responses = numpy.multiply(
+                responses, numpy.repeat(a, lengths),
+                out=responses if responses.dtype == float else None)
+            responses += b
+
+        return TraceStore(times, responses, offsets,
+                          {k: v[positions]
+                           for k, v in file.store.columns.items()})
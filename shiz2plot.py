@@ -1,24 +1,26 @@
 #!/usr/bin/env python3
 
 import argparse
+import glob
+import os
 import sys
+import time
 
-import matplotlib.pyplot as plt
-import matplotlib.transforms as mtransforms
-import matplotlib.lines as mlines
-
-from chrom.plot import Plot
+# Plotting, processing and config modules are imported by the stages that
+# use them, keeping startup fast for --listkeys and report only runs
+from chrom.cache import Cache
+from chrom.file import File, load_files, save_files
 from chrom.filter import Filter
 from chrom.options import Options
 from chrom.keywords import Keywords
 
-import util.latex as latex
+import util.timing as timing
 from util.colors import base16_colors
-from util.config import import_cfg
+from util.timing import stage
 
 DEFAULTS = {
     "filter": {},
-    "options": {"colorby": "channel"},
+    "options": {"colorby": "channel", "decimate": True},
     "plotkws": {"linewidth": 0.75},
 }
 
@@ -44,7 +46,8 @@ class ListKeysAction(argparse.Action):
         parser.exit()
 
 
-def parse_args(args):
+def parse_args(args, files=None):
+    """files -> optional dict of parsed Files by path, see load_files."""
     parser = argparse.ArgumentParser(
         description="Plots Shimadzu chromatography data.",
         epilog="For filters, options, plotkws see listkeys.",
@@ -61,10 +64,70 @@ def parse_args(args):
         "--config",
         help="Import options from a config file," " ignores other inputs.",
     )
+    parser.add_argument(
+        "--batch",
+        metavar="<config>",
+        help="Render every figure of a batch config, see util.batch.",
+    )
+    parser.add_argument(
+        "--serve",
+        metavar="<socket>",
+        help="Render requests sent to a unix socket, see util.server.",
+    )
     parser.add_argument("-o", "--output", help="Output filename and format.")
+    parser.add_argument(
+        "--report",
+        metavar="<file>",
+        help="Write the areas of integrated files to a tab separated file.",
+    )
     parser.add_argument(
         "-S", "--noshow", action="store_true", help="Don't show the image."
     )
+    parser.add_argument(
+        "--watch",
+        nargs="?",
+        type=float,
+        const=2.0,
+        metavar="SECONDS",
+        help="Poll the input files and config, redrawing axes when they change.",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="",
+        metavar="<file>",
+        help="Print the time and memory of each stage, and write them as json.",
+    )
+    parser.add_argument(
+        "--cprofile",
+        metavar="<stage>[:<file>]",
+        help="Run a stage, such as parse or savefig, under cProfile.",
+    )
+    # Cache
+    parser.add_argument("--cache-dir", help="Directory for cached parsed files.")
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        default=512,
+        metavar="MB",
+        help="Maximum size of the cache.",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Don't cache parsed files."
+    )
+    parser.add_argument(
+        "--catalog",
+        metavar="<file>",
+        help="Catalog of the files in input directories, in the default cache dir.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Parse input files, or render batch figures, in N processes.",
+    )
     # Options
     parser.add_argument(
         "--hstack", action="store_true", help="Stack plots horizontally."
@@ -85,6 +148,11 @@ def parse_args(args):
     parser.add_argument(
         "-f", "--filter", metavar="<key>=<value>,...", help="Filter all files."
     )
+    parser.add_argument(
+        "--library",
+        metavar="<csv>",
+        help="Compound library for event names, see util/lookups.py.",
+    )
     parser.add_argument(
         "-p",
         "--options",
@@ -122,26 +190,87 @@ def parse_args(args):
 
     args = parser.parse_args(args)
 
+    if args.profile is not None or args.cprofile is not None:
+        timing.enable(None if args.cprofile is None else args.cprofile.split(":")[0])
+
+    # Event names in filters are resolved with the library
+    Filter.LIBRARY = args.library
+    if args.library is not None:
+        from util.lookups import load_library
+
+        try:
+            load_library(args.library)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+
     # Import the config if it exists
+    defaults = {key: val.copy() for key, val in DEFAULTS.items()}
+    # Decimated lines lose detail once zoomed, so shown figures are not
+    if not args.noshow:
+        defaults["options"]["decimate"] = False
     if args.config is not None:
-        cfgfiles, defaults = import_cfg(args.config)
-        for key, val in defaults.items():
-            DEFAULTS[key].update(val)
+        from util.config import import_cfg
+
+        try:
+            cfgfiles, cfgdefaults = import_cfg(
+                args.config,
+                {"filter": Filter.VALID_KEYS, "options": Options.VALID_KEYS},
+            )
+        except KeyError as e:
+            parser.error(
+                "Invalid {} key '{}' in {}".format(e.args[1], e.args[0], args.config)
+            )
+        except TypeError as e:
+            parser.error(str(e))
+        for key, val in cfgdefaults.items():
+            defaults[key].update(val)
         args.infiles.extend(cfgfiles)
 
+    # Expand globs and directories in file paths, the patterns are kept for --watch
+    args.sources = list(args.infiles)
+    args.infiles = expand_infiles(
+        args.infiles, lambda f, paths: select_exports(args, defaults, f, paths)
+    )
+
+    # Reset for each run, as servers render many figures in one process
+    File.CACHE = None if args.no_cache else Cache(args.cache_dir, args.cache_size * 1e6)
+
+    # Figures are read and rendered by main
+    if args.batch is not None or args.serve is not None:
+        return vars(args)
+
     # Parse infiles and update the default options
     if args.infiles is not None:
+        from chrom.plot import Plot
+
         infiles = []
-        for f in args.infiles:
+        # Workers parsing in parallel only load the traces selected
+        filters = None
+        if args.jobs > 1:
             try:
-                infiles.append(
-                    Plot(
-                        f,
-                        Filter(args.filter, **DEFAULTS["filter"]),
-                        Options(args.options, **DEFAULTS["options"]),
-                        Keywords(args.plotkws, **DEFAULTS["plotkws"]),
-                    )
+                filters = [infile_filter(args, defaults, f) for f in args.infiles]
+            except KeyError as e:
+                parser.error(
+                    "Invalid {} key '{}'".format(e.args[1].__name__, e.args[0])
+                )
+        parsed = load_files(
+            [infile_path(f) for f in args.infiles], args.jobs, files, filters
+        )
+        for f, file in zip(args.infiles, parsed):
+            try:
+                plot = Plot(
+                    f if isinstance(f, str) else "",
+                    Filter(args.filter, **defaults["filter"]),
+                    Options(args.options, **defaults["options"]),
+                    Keywords(args.plotkws, **defaults["plotkws"]),
+                    file=file,
                 )
+                # Config entries are already typed and checked
+                if isinstance(f, dict):
+                    plot.filter.update(f["filter"], overwrite=True)
+                    plot.options.update(f["options"], overwrite=True)
+                    plot.plotkws.update(f["plotkws"], overwrite=True)
+                infiles.append(plot)
             except KeyError as e:
                 parser.error(
                     "Invalid {} key '{}'".format(e.args[1].__name__, e.args[0])
@@ -158,7 +287,183 @@ def parse_args(args):
     return vars(args)
 
 
+def infile_path(infile):
+    """The path of an infile string, or of a config file entry."""
+    return infile["path"] if isinstance(infile, dict) else infile.split(":")[0]
+
+
+def expand_infiles(infiles, select=None):
+    """Replaces infiles whose path is a glob or a directory with one per
+    matching file. Files in a directory are narrowed by 'select', a function
+    taking the infile and paths and returning the paths to keep."""
+    expanded = []
+    for f in infiles:
+        path = infile_path(f)
+        # Existing files are never patterns, even if named like one
+        if os.path.isfile(path):
+            expanded.append(f)
+            continue
+        if glob.has_magic(path):
+            paths = sorted(glob.glob(path))
+        elif os.path.isdir(path):
+            paths = sorted(
+                os.path.join(path, name)
+                for name in os.listdir(path)
+                if os.path.isfile(os.path.join(path, name))
+            )
+            if select is not None:
+                paths = select(f, paths)
+        else:
+            expanded.append(f)
+            continue
+        if isinstance(f, dict):
+            expanded.extend(dict(f, path=p) for p in paths)
+        else:
+            rest = f[len(path) :]
+            expanded.extend(p + rest for p in paths)
+    return expanded
+
+
+def select_exports(args, defaults, infile, paths):
+    """Paths of the files in 'paths' with traces passing the filter of
+    'infile', found with the catalog instead of parsing each file."""
+    from chrom.catalog import Catalog
+
+    with Catalog(args.catalog) as catalog:
+        catalog.update(paths)
+        return catalog.select(infile_filter(args, defaults, infile), paths)
+
+
+def infile_filter(args, defaults, infile):
+    """The Filter of 'infile', as its Plot will have."""
+    filter = Filter(args.filter, **defaults["filter"])
+    if isinstance(infile, dict):
+        filter.update(infile["filter"], overwrite=True)
+    elif ":" in infile:
+        filter.parse(infile.split(":")[1])
+    return filter
+
+
+def watch_signature(args):
+    """Size and modification time of the config and every input file."""
+    paths = [infile_path(f) for f in expand_infiles(args["sources"])]
+    if args["config"] is not None:
+        paths.append(args["config"])
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            signature.append((path, None, None))
+    return signature
+
+
+def watch(argv, args, axes, collections, files):
+    """Polls the inputs of 'args' every args["watch"] seconds until
+    interrupted. Changed and new files are parsed again, unchanged ones
+    are reused from 'files', and only axes with changed plots are redrawn.
+    Returns True if the number of axes changed and the figure needs to be
+    rebuilt."""
+    import matplotlib.pyplot as plt
+    from chrom.plot import LineGroups
+
+    def keys(infiles):
+        """The plots of each axes, with the state of their file."""
+        plots = {}
+        for f in infiles:
+            ax = f.assign_axis(axes, args["hstack"])
+            plots.setdefault(ax, []).append(
+                (
+                    f.file.path,
+                    f.file.stat,
+                    repr(f.filter.get()),
+                    repr(f.options.get()),
+                    repr(f.plotkws.get()),
+                )
+            )
+        return plots
+
+    signature = watch_signature(args)
+    try:
+        while True:
+            if args["noshow"]:
+                time.sleep(args["watch"])
+            else:
+                plt.pause(args["watch"])
+            current = watch_signature(args)
+            if current == signature:
+                continue
+            signature = current
+
+            File.FILE_ID = 0
+            try:
+                new = parse_args(argv, files)
+            except SystemExit:
+                # Such as a config that is being written
+                continue
+            shape = calculate_required_axes(new["infiles"], new["hstack"])
+            if shape != axes.shape:
+                return True
+
+            old_keys, new_keys = keys(args["infiles"]), keys(new["infiles"])
+            changed = [
+                ax
+                for ax in axes.flatten()
+                if old_keys.get(ax, []) != new_keys.get(ax, [])
+            ]
+            for ax in changed:
+                for f in args["infiles"]:
+                    if f.assign_axis(axes, args["hstack"]) is ax:
+                        f.clear()
+                for collection in [c for c in collections if c.axes is ax]:
+                    collection.remove()
+                    collections.remove(collection)
+                ax.relim()
+                groups = LineGroups()
+                for f in new["infiles"]:
+                    if f.assign_axis(axes, args["hstack"]) is ax:
+                        f.plot(axes, args["hstack"], groups)
+                collections.extend(groups.draw())
+                ax.autoscale_view()
+
+            # Plots of unchanged axes are kept with their artists
+            kept = {}
+            for f in args["infiles"]:
+                ax = f.assign_axis(axes, args["hstack"])
+                if ax not in changed:
+                    kept.setdefault(ax, []).append(f)
+            for i, f in enumerate(new["infiles"]):
+                ax = f.assign_axis(axes, args["hstack"])
+                if ax in kept:
+                    new["infiles"][i] = kept[ax].pop(0)
+            args = new
+            if args["report"]:
+                write_report(args["report"], args["infiles"])
+            if args["output"]:
+                plt.savefig(args["output"])
+            save_files([f.file for f in args["infiles"]])
+            print("Redrew {} axes".format(len(changed)))
+    except KeyboardInterrupt:
+        return False
+
+
+def write_profile(args):
+    """Prints and writes the stages recorded since parse_args, if any."""
+    profiler = timing.disable()
+    if profiler is None:
+        return
+    profiler.print_summary()
+    if args["profile"]:
+        profiler.write(args["profile"])
+    if profiler.profile is not None:
+        name, _, path = args["cprofile"].partition(":")
+        profiler.profile.dump_stats(path or name + ".prof")
+
+
 def add_annotations(annotations, axes):
+    import matplotlib.pyplot as plt
+
     default_kwargs = {
         "xycoords": "axes fraction",
         "textcoords": "axes fraction",
@@ -184,6 +489,9 @@ def add_annotations(annotations, axes):
 
 
 def add_legends(legends):
+    import matplotlib.lines as mlines
+    import matplotlib.pyplot as plt
+
     lines = []
     for i, label in enumerate(legends):
         line = mlines.Line2D(
@@ -197,6 +505,22 @@ def add_legends(legends):
     plt.legend(handles=lines, framealpha=1.0, fancybox=False)
 
 
+def write_report(path, infiles):
+    keys = ["event", "channel", "precursor", "product"]
+    with open(path, "w") as fp:
+        fp.write("\t".join(["path", "name", "id"] + keys + ["start", "end", "area"]))
+        fp.write("\n")
+        for f in infiles:
+            if not hasattr(f.options, "integrate"):
+                continue
+            columns = f.file.store.columns
+            for area in f.integrate():
+                row = [f.file.path, f.file.name, f.file.id]
+                row.extend(columns[key][area["trace"]] for key in keys)
+                row.extend([area["start"], area["end"], area["area"]])
+                fp.write("\t".join(str(x) for x in row) + "\n")
+
+
 def calculate_required_axes(infiles, hstack=False):
     nrows, ncols = 0, 0
     for f in infiles:
@@ -216,6 +540,8 @@ def calculate_required_axes(infiles, hstack=False):
 
 
 def set_shared_ylabel(ylabel, axes, figure):
+    import matplotlib.transforms as mtransforms
+
     bottom, top = 0.1, 0.9
     avepos = (bottom + top) / 2
     # changed from default blend (IdentityTransform(), axes[0].transAxes)
@@ -228,29 +554,73 @@ def set_shared_ylabel(ylabel, axes, figure):
     axes[0].set_ylabel(ylabel)
 
 
-def main(args):
-    args = parse_args(args)
+def main(args, files=None):
+    """files -> optional dict of parsed Files by path, reused if unchanged.
+    Returns the path of the saved figure, if any."""
+    argv, files = args, {} if files is None else files
+    args = parse_args(argv, files)
+
+    if args["serve"] is not None:
+        from util.server import serve
+
+        serve(args["serve"], main)
+        return
+
+    if args["batch"] is not None:
+        from util.batch import render_batch
+
+        # Figures use the cache settings of the batch
+        cache_args = ["--no-cache"] if args["no_cache"] else []
+        if args["cache_dir"] is not None:
+            cache_args += ["--cache-dir", args["cache_dir"]]
+        cache_args += ["--cache-size", str(args["cache_size"])]
+        render_batch(args["batch"], main, args["jobs"], cache_args)
+        return
+
+    # Nothing to draw, skip importing matplotlib
+    if args["output"] is None and args["noshow"] and args["watch"] is None:
+        if args["report"]:
+            with stage("report"):
+                write_report(args["report"], args["infiles"])
+        with stage("cache"):
+            save_files([f.file for f in args["infiles"]])
+        write_profile(args)
+        return
+
+    import matplotlib
+
+    if args["noshow"]:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    import util.latex as latex
+    from chrom.plot import LineGroups
 
     subplot_kw = {"xlabel": "", "ylabel": "", "xmargin": 0}
     if not args["notex"]:
         latex.plot_options()
 
     # Calculated required axes
-    fig, axes = plt.subplots(
-        *calculate_required_axes(args["infiles"], args["hstack"]),
-        squeeze=False,
-        figsize=latex.size(*args["scale"]),
-        tight_layout=True,
-        dpi=args["dpi"],
-        sharex=True,
-        sharey=True,
-        subplot_kw=subplot_kw,
-        gridspec_kw={"wspace": 0, "hspace": 0}
-    )
+    with stage("figure"):
+        fig, axes = plt.subplots(
+            *calculate_required_axes(args["infiles"], args["hstack"]),
+            squeeze=False,
+            figsize=latex.size(*args["scale"]),
+            tight_layout=True,
+            dpi=args["dpi"],
+            sharex=True,
+            sharey=True,
+            subplot_kw=subplot_kw,
+            gridspec_kw={"wspace": 0, "hspace": 0}
+        )
 
-    # Plot data
+    # Plot data, collected traces are drawn together once all are added
+    groups = LineGroups()
     for f in args["infiles"]:
-        f.plot(axes, args["hstack"])
+        with stage("plot", file=f.file.path):
+            f.plot(axes, args["hstack"], groups)
+    with stage("collections"):
+        collections = groups.draw()
 
     # Cleanup axes
     for ax in axes.flatten():
@@ -288,14 +658,31 @@ def main(args):
     plt.xlabel(args["xlabel"])
 
     # Remove uneeded withspace
-    plt.tight_layout()
+    with stage("tight_layout"):
+        plt.tight_layout()
 
     # Save and/or show the output
+    if args["report"]:
+        with stage("report"):
+            write_report(args["report"], args["infiles"])
     if args["output"]:
-        plt.savefig(args["output"])
-    if not args["noshow"]:
+        with stage("savefig"):
+            plt.savefig(args["output"])
+    # Traces loaded by this figure are cached once
+    with stage("cache"):
+        save_files([f.file for f in args["infiles"]])
+    write_profile(args)
+    if args["watch"] is not None:
+        if not args["noshow"]:
+            plt.show(block=False)
+        if watch(argv, args, axes, collections, files):
+            plt.close(fig)
+            File.FILE_ID = 0
+            return main(argv, files)
+    elif not args["noshow"]:
         plt.show()
-    return
+    plt.close(fig)
+    return args["output"]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,163 @@
+"""Renders many figures from one config, see import_batch.
+
+A batch config is a yaml file such as:
+
+    args: [-T, --dpi, 150]
+    figures:
+      - output: overlay.pdf
+        infiles: ['a.txt:event=3', 'b.txt:event=3']
+        args: [--hstack]
+    template:
+      files: [data/*.txt]
+      events: [3, 5]
+      output: 'out/{stem}_{event}.pdf'
+      infiles: ['{path}:event={event}']
+
+'args' are passed to every figure. Each figure takes the arguments of
+shiz2plot. The template makes one figure per file and event, expanding
+{path}, {stem} (the file name without extension) and {event}.
+"""
+import contextlib
+import glob
+import io
+import multiprocessing
+import os
+import sys
+
+import yaml
+
+from chrom.file import File
+
+# Files parsed by this process, reused across figures
+_FILES = {}
+_MAIN = None
+
+
+def import_batch(path: str):
+    """Returns a list of (output, infiles, args) for each figure."""
+    with open(path, 'r') as fp:
+        cfg = yaml.safe_load(fp)
+
+    shared = [str(x) for x in cfg.get('args', [])]
+    figures = []
+    for figure in cfg.get('figures', []):
+        if 'output' not in figure:
+            raise ValueError('Batch figure {} has no output!'.format(
+                figure.get('infiles')))
+        figures.append((figure['output'], list(figure['infiles']),
+                        shared + [str(x) for x in figure.get('args', [])]))
+    if 'template' in cfg:
+        figures.extend(_expand_template(cfg['template'], shared))
+    return figures
+
+
+def _expand_template(template: dict, shared: list):
+    paths = []
+    for pattern in template['files']:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    figures = []
+    for path in paths:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        for event in template.get('events', ['']):
+            keys = {'path': path, 'stem': stem, 'event': event}
+            figures.append((
+                template['output'].format(**keys),
+                [f.format(**keys) for f in template['infiles']],
+                shared + [str(x).format(**keys)
+                          for x in template.get('args', [])]))
+    return figures
+
+
+def _tasks(figures: list):
+    """Groups figures that share any file, so each file is parsed by one
+    process only and reused by all its figures. Returns the groups,
+    largest first."""
+    owner = {}
+
+    def find(path):
+        while owner[path] != path:
+            owner[path] = owner[owner[path]]
+            path = owner[path]
+        return path
+
+    # Union the files read by each figure
+    for figure in figures:
+        paths = [f.split(':')[0] for f in figure[1]]
+        for path in paths:
+            owner.setdefault(path, path)
+        for path in paths[1:]:
+            owner[find(path)] = find(paths[0])
+
+    groups = {}
+    for figure in figures:
+        key = find(figure[1][0].split(':')[0]) if len(figure[1]) > 0 \
+            else None
+        groups.setdefault(key, []).append(figure)
+    return sorted(groups.values(), key=len, reverse=True)
+
+
+def _init_worker(main, cache):
+    global _MAIN
+    _MAIN = main
+    File.CACHE = cache
+
+
+def _render(figures: list):
+    """Renders 'figures' with _MAIN, returning their outputs and a list of
+    (output, message) for figures that failed."""
+    import matplotlib
+    matplotlib.use('Agg')
+
+    outputs, failures = [], []
+    for output, infiles, args in figures:
+        # Each figure numbers its files from 0, as a single run does
+        File.FILE_ID = 0
+        stderr = io.StringIO()
+        try:
+            with contextlib.redirect_stderr(stderr):
+                _MAIN(args + ['-S', '-o', output] + infiles, files=_FILES)
+            outputs.append(output)
+        except SystemExit as e:
+            # Argument errors are printed by argparse, keep the last line
+            lines = stderr.getvalue().strip().splitlines()
+            failures.append((output, lines[-1] if len(lines) > 0
+                             else 'exit status {}'.format(e.code)))
+        except Exception as e:
+            failures.append((output, '{}: {}'.format(type(e).__name__, e)))
+        sys.stderr.write(stderr.getvalue())
+    return outputs, failures
+
+
+def render_batch(path: str, main, jobs=1, args=None):
+    """Renders every figure of the batch config 'path'.
+    Figures that fail are skipped and listed once the others are done,
+    exiting with status 1.
+    main -> function taking the arguments of a figure and a dict of Files,
+            as shiz2plot.main.
+    jobs -> number of rendering processes.
+    args -> extra arguments passed to every figure."""
+    figures = [(output, infiles, figargs + (args or []))
+               for output, infiles, figargs in import_batch(path)]
+    tasks = _tasks(figures)
+    failures = []
+    if jobs <= 1 or len(tasks) < 2:
+        _init_worker(main, File.CACHE)
+        for task in tasks:
+            failures.extend(_print_outputs(*_render(task)))
+    else:
+        with multiprocessing.Pool(min(jobs, len(tasks)),
+                                  initializer=_init_worker,
+                                  initargs=(main, File.CACHE)) as pool:
+            for result in pool.imap_unordered(_render, tasks):
+                failures.extend(_print_outputs(*result))
+
+    if len(failures) > 0:
+        for output, message in failures:
+            sys.stderr.write('Failed {}: {}\n'.format(output, message))
+        sys.exit(1)
+
+
+def _print_outputs(outputs: list, failures: list):
+    for output in outputs:
+        print(output)
+    return failures
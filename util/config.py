@@ -1,38 +1,62 @@
 import yaml
 from util.valueparse import convert_string_values
 
+SECTIONS = ['filter', 'options', 'plotkws']
+# libyaml is used if available
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def typed_value(value):
+    """Yaml values are typed, except tuples and None which are written as
+    strings in the command line syntax."""
+    if isinstance(value, str) and (value.startswith(('(', '['))
+                                   or value == 'None'):
+        return convert_string_values(value)
+    return value
+
+
+def check_section(name: str, section, valid_keys=None):
+    """Returns 'section' with lower case keys and typed values.
+    Raises a KeyError for keys not in valid_keys, if given."""
+    if section is None:
+        return {}
+    if not isinstance(section, dict):
+        raise TypeError('Config: {} must be a mapping, not {}.'.format(
+            name, type(section).__name__))
+    checked = {}
+    for key, value in section.items():
+        key = str(key).lower()
+        if valid_keys is not None and key not in valid_keys:
+            raise KeyError(key, name)
+        checked[key] = typed_value(value)
+    return checked
+
+
+def import_cfg(path: str, valid_keys: dict = None):
+    """Returns the file entries and default sections of a config.
+    Each entry is a dict of 'path' and the filter, options and plotkws
+    sections, checked once here and passed on without reparsing.
+    valid_keys -> optional dict of the valid keys of each section."""
+    valid_keys = {} if valid_keys is None else valid_keys
 
-def stringify_dict(d: dict):
-    return ",".join(["{}={}".format(k, v) for k, v in d.items()])
-
+    with open(path, 'r') as fp:
+        cfg = yaml.load(fp, Loader=Loader) or {}
 
-def import_cfg(path: str):
+    defaults = {key: check_section(key, cfg.get(key), valid_keys.get(key))
+                for key in SECTIONS}
 
-    defaults = {'filter': {}, 'options': {}, 'plotkws': {}}
+    entries = cfg.get('files', [])
+    # Files may be a list or a mapping of names to entries
+    if isinstance(entries, dict):
+        entries = list(entries.values())
     files = []
-
-    with open(path, 'r') as fp:
-        cfg = yaml.load(fp, Loader=yaml.BaseLoader)
-
-        for key in cfg.keys():
-            if key in defaults.keys():
-                try:
-                    defaults[key] = {k.lower(): convert_string_values(v)
-                                     for k, v in cfg[key].items()}
-                except (IndexError, TypeError) as e:
-                    print(key, e)
-        if 'files' in cfg.keys():
-            for key, val in cfg['files'].items():
-                file = {'filter': {}, 'options': {}, 'plotkws': {}}
-                for fkey in file.keys():
-                    try:
-                        file[fkey] = val[fkey]
-                    except KeyError:
-                        pass
-                files.append("{}:{}:{}:{}".format(
-                    val['path'],
-                    stringify_dict(file['filter']),
-                    stringify_dict(file['options']),
-                    stringify_dict(file['plotkws'])))
+    for entry in entries:
+        if not isinstance(entry, dict) or 'path' not in entry:
+            raise KeyError('path', 'files')
+        file = {'path': str(entry['path'])}
+        for key in SECTIONS:
+            file[key] = check_section(key, entry.get(key),
+                                      valid_keys.get(key))
+        files.append(file)
 
     return files, defaults
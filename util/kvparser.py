@@ -63,7 +63,7 @@ class KeyValParser(object):
             if not self._key_is_valid(key):
                 raise KeyError(key, self.__class__)
             if overwrite or not hasattr(self, key):
-                setattr(self, key, val)
+                setattr(self, key, self._lookup_key(key, val))
 
     def get(self):
         return self.__dict__
@@ -1,36 +1,116 @@
-EVENT_LOOKUP = {
-        "PFBA": 1,
-        "MPFBA": 2,
-        "PFPeA": 3,
-        "M5PFPeA": 4,
-        "PFBS": 5,
-        "M3PFBS": 6,
-        "PFHxA": 7,
-        "M5PFHxA": 8,
-        "PFPeS": 9,
-        "PFHpA": 10,
-        "M4PFHpA": 11,
-        "PFHxS": 12,
-        "M3PFHxS": 13,
-        "PFOA": 14,
-        "M8PFOA": 15,
-        "PFHpS": 16,
-        "PFNA": 17,
-        "M9PFNA": 18,
-        "PFOS": 19,
-        "M8PFOS": 20,
-        "PFDA": 21,
-        "M6PFDA": 22,
-        "PFNS": 23,
-        "PFUnA": 24,
-        "M7PFUnA": 25,
-        "PFDS": 26,
-        "PFDoA": 27,
-        "MPFDoA": 28,
-        "PFTrDA": 29,
-        "PFDoS": 30,
-        "PFTeDA": 31,
-        "M2PFTeDA": 32,
-        "PFHxDA": 33,
-        "PFODA": 34
-}
+"""Compound library, mapping compound names to their event and transition.
+
+A library is a csv file with the columns name, event, precursor, product
+and standard, where standard is the name of the mass labelled internal
+standard of a native compound. Lines starting with '#' are comments and
+empty fields are unknown. The default library is util/compounds.csv.
+
+A name followed by '+IS', such as PFOA+IS, stands for the compound and its
+internal standard.
+"""
+import collections
+import csv
+import os
+
+from util.valueparse import Range
+
+Compound = collections.namedtuple(
+    'Compound', ['name', 'event', 'precursor', 'product', 'standard'])
+
+DEFAULT_LIBRARY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'compounds.csv')
+# Compiled libraries by path, with the size and mtime they were read at
+_LIBRARIES = {}
+# Largest difference in m/z between a library transition and a trace
+MZ_TOLERANCE = 0.05
+
+
+class Library(object):
+    """Compounds indexed by case insensitive name."""
+
+    def __init__(self, compounds: list):
+        self.compounds = collections.OrderedDict()
+        for compound in compounds:
+            key = compound.name.lower()
+            if key in self.compounds:
+                raise ValueError('Library: duplicate compound {}.'.format(
+                    compound.name))
+            self.compounds[key] = compound
+        for compound in self.compounds.values():
+            if compound.standard is None:
+                continue
+            if compound.standard.lower() not in self.compounds:
+                raise ValueError('Library: unknown standard {} of {}.'.format(
+                    compound.standard, compound.name))
+
+    def __contains__(self, name: str):
+        return name.lower() in self.compounds
+
+    def get(self, name: str):
+        """The Compound 'name', or None."""
+        return self.compounds.get(name.lower())
+
+    def event(self, name: str):
+        """The event of compound 'name', or None if unknown."""
+        compound = self.compounds.get(name.lower())
+        return None if compound is None else compound.event
+
+    def standard(self, name: str):
+        """The internal standard Compound of the native 'name', or None."""
+        compound = self.compounds.get(name.lower())
+        if compound is None or compound.standard is None:
+            return None
+        return self.compounds[compound.standard.lower()]
+
+    def expand(self, name: str):
+        """The names 'name' stands for, two for a native with '+IS' and its
+        standard, otherwise only 'name'."""
+        if name.upper().endswith('+IS'):
+            standard = self.standard(name[:-3])
+            if standard is not None:
+                return [self.compounds[name[:-3].lower()].name, standard.name]
+        return [name]
+
+    def criteria(self, name: str):
+        """The trace values of compound 'name' as a dict of filter keys, its
+        event if known, otherwise its transition within MZ_TOLERANCE.
+        Empty if the compound is unknown or has neither."""
+        compound = self.compounds.get(name.lower())
+        if compound is None:
+            return {}
+        if compound.event is not None:
+            return {'event': compound.event}
+        return {key: Range(value - MZ_TOLERANCE, value + MZ_TOLERANCE)
+                for key, value in [('precursor', compound.precursor),
+                                   ('product', compound.product)]
+                if value is not None}
+
+
+def _field(value: str, convert):
+    value = (value or '').strip()
+    return convert(value) if len(value) > 0 else None
+
+
+def read_library(path: str):
+    """Reads the csv library at 'path'."""
+    with open(path, 'r', newline='') as fp:
+        rows = csv.DictReader(
+            line for line in fp if not line.lstrip().startswith('#'))
+        compounds = [Compound(row['name'].strip(),
+                              _field(row.get('event'), int),
+                              _field(row.get('precursor'), float),
+                              _field(row.get('product'), float),
+                              _field(row.get('standard'), str))
+                     for row in rows if _field(row.get('name'), str)]
+    return Library(compounds)
+
+
+def load_library(path=None):
+    """Returns the Library at 'path', or the default library.
+    Each library is read once and again only after its file changes."""
+    path = os.path.abspath(DEFAULT_LIBRARY if path is None else path)
+    stat = os.stat(path)
+    stat = (stat.st_size, stat.st_mtime_ns)
+    if path not in _LIBRARIES or _LIBRARIES[path][0] != stat:
+        _LIBRARIES[path] = (stat, read_library(path))
+    return _LIBRARIES[path][1]
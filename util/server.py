@@ -0,0 +1,128 @@
+"""Runs shiz2plot in a long lived process, keeping parsed files and
+matplotlib loaded between figures.
+
+Start the server with:
+    shiz2plot.py --serve <socket>
+then render with the same arguments as shiz2plot:
+    python util/server.py <socket> <arguments>
+
+The client only imports the standard library, so starts quickly from any
+directory. Requests run one at a time,
+in the working directory of the client, and the server's stdout and
+stderr are sent back to it.
+"""
+import contextlib
+import io
+import json
+import os
+import socket
+import sys
+
+
+def _receive(conn):
+    chunks = []
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            return b''.join(chunks).decode()
+        chunks.append(chunk)
+
+
+def serve(path: str, main):
+    """Answers requests on the unix socket 'path' until interrupted.
+    main -> function taking shiz2plot arguments and a dict of Files,
+            returning the output path, as shiz2plot.main."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot  # Imported once for every request
+
+    files = {}
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+        os.chmod(path, 0o600)
+        server.listen(8)
+        print('Serving on {}'.format(path))
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                reply = _run(main, json.loads(_receive(conn)), files)
+                conn.sendall(json.dumps(reply).encode())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _blocking_flag(args: list):
+    """The first argument of 'args' that would block or fork the server,
+    --serve, --watch or --batch, in any form argparse accepts."""
+    for arg in args:
+        if arg == '--':
+            break
+        name = arg.split('=')[0]
+        if len(name) > 2 and name.startswith('--'):
+            for flag in ['--serve', '--watch', '--batch']:
+                if flag.startswith(name):
+                    return flag
+    return None
+
+
+def _run(main, request: dict, files: dict):
+    """Runs main for one request, returning the reply.
+    Each request starts from the same matplotlib settings and any figures
+    it leaves open are closed."""
+    import matplotlib
+    import matplotlib.pyplot as plt
+    from chrom.file import File
+
+    stdout, stderr = io.StringIO(), io.StringIO()
+    status, output = 0, None
+    cwd = os.getcwd()
+    try:
+        os.chdir(request['cwd'])
+        with contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(stderr), matplotlib.rc_context():
+            flag = _blocking_flag(request['args'])
+            if flag is not None:
+                raise ValueError('Cannot {} from a request!'.format(flag))
+            # Each figure numbers its files from 0, as a single run does
+            File.FILE_ID = 0
+            output = main(request['args'] + ['-S'], files=files)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    except Exception as e:
+        status = 1
+        stderr.write('{}: {}\n'.format(type(e).__name__, e))
+    finally:
+        plt.close('all')
+        os.chdir(cwd)
+    return {'status': status, 'output': output,
+            'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+
+def request(path: str, args: list):
+    """Sends 'args' to the server at 'path', printing its output.
+    Returns the exit status of the request."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with client:
+        client.connect(path)
+        client.sendall(json.dumps(
+            {'args': args, 'cwd': os.getcwd()}).encode())
+        client.shutdown(socket.SHUT_WR)
+        reply = json.loads(_receive(client))
+    sys.stdout.write(reply['stdout'])
+    sys.stderr.write(reply['stderr'])
+    if reply['output'] is not None:
+        print(reply['output'])
+    return reply['status']
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit('Usage: server.py <socket> <arguments>')
+    sys.exit(request(sys.argv[1], sys.argv[2:]))
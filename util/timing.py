@@ -0,0 +1,114 @@
+"""Wall time, cpu time and peak memory of the stages of a run.
+
+Code marks a stage with:
+    with stage('filter', file=path) as record:
+        ...
+        record['traces'] = len(traces)
+
+While disabled, stage returns one shared no-op context, so the hooks can
+stay in place. Keyword arguments and items set on the record are stored
+with the timings. While enabled, memory is traced with tracemalloc, which
+slows allocation heavy code such as module imports.
+"""
+import collections
+import contextlib
+import cProfile
+import json
+import sys
+import time
+import tracemalloc
+
+_NOOP = contextlib.nullcontext({})
+_PROFILER = None
+
+
+class Profiler(object):
+    """Records every stage run while it is enabled.
+    cprofile -> name of a stage to run under cProfile, or None."""
+
+    def __init__(self, cprofile=None):
+        self.records = []
+        self.cprofile = cprofile
+        self.profile = cProfile.Profile() if cprofile is not None else None
+        # Peak memory of the stages that are running, innermost last
+        self._peaks = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str, info: dict):
+        record = dict(info, stage=name)
+        profiled = name == self.cprofile
+        memory = tracemalloc.get_traced_memory()
+        # The peak of an outer stage is kept before measuring this one
+        if len(self._peaks) > 0:
+            self._peaks[-1] = max(self._peaks[-1], memory[1])
+        self._peaks.append(0)
+        tracemalloc.reset_peak()
+        wall, cpu = time.perf_counter(), time.process_time()
+        if profiled:
+            self.profile.enable()
+        try:
+            yield record
+        finally:
+            if profiled:
+                self.profile.disable()
+            record['wall'] = time.perf_counter() - wall
+            record['cpu'] = time.process_time() - cpu
+            peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1])
+            record['memory'] = max(peak - memory[0], 0)
+            if len(self._peaks) > 0:
+                self._peaks[-1] = max(self._peaks[-1], peak)
+            self.records.append(record)
+
+    def summary(self):
+        """Returns the count, total wall and cpu times, and largest peak
+        memory of each stage, in order of first use."""
+        stages = collections.OrderedDict()
+        for record in self.records:
+            total = stages.setdefault(record['stage'], {
+                'count': 0, 'wall': 0.0, 'cpu': 0.0, 'memory': 0})
+            total['count'] += 1
+            total['wall'] += record['wall']
+            total['cpu'] += record['cpu']
+            total['memory'] = max(total['memory'], record['memory'])
+        return stages
+
+    def print_summary(self, file=None):
+        """Prints the summary to 'file', by default the current stderr."""
+        file = sys.stderr if file is None else file
+        print('{:<14} {:>6} {:>10} {:>10} {:>12}'.format(
+            'stage', 'count', 'wall (s)', 'cpu (s)', 'peak (MB)'), file=file)
+        for name, total in self.summary().items():
+            print('{:<14} {:>6} {:>10.4f} {:>10.4f} {:>12.2f}'.format(
+                name, total['count'], total['wall'], total['cpu'],
+                total['memory'] / 1e6), file=file)
+
+    def write(self, path: str):
+        """Writes the records and summary as json."""
+        with open(path, 'w') as fp:
+            json.dump({'summary': self.summary(), 'records': self.records},
+                      fp, indent=1, default=str)
+
+
+def stage(name: str, **info):
+    """Context timing the stage 'name', see Profiler.stage."""
+    if _PROFILER is None:
+        return _NOOP
+    return _PROFILER.stage(name, info)
+
+
+def enable(cprofile=None):
+    """Starts recording stages, and tracing memory allocations."""
+    global _PROFILER
+    _PROFILER = Profiler(cprofile)
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return _PROFILER
+
+
+def disable():
+    """Stops recording, returning the Profiler or None."""
+    global _PROFILER
+    profiler, _PROFILER = _PROFILER, None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return profiler
@@ -1,13 +1,60 @@
+import re
+
+
+class Range(object):
+    """Closed interval [lo, hi] that compares equal to the numbers within
+    it, so it can be used wherever an exact value is matched."""
+    __slots__ = ['lo', 'hi']
+
+    def __init__(self, lo: float, hi: float):
+        self.lo, self.hi = lo, hi
+
+    def __eq__(self, other):
+        if isinstance(other, Range):
+            return self.lo == other.lo and self.hi == other.hi
+        try:
+            return self.lo <= other <= self.hi
+        except TypeError:
+            return False
+
+    def __hash__(self):
+        return hash((self.lo, self.hi))
+
+    def __repr__(self):
+        return '{}..{}'.format(self.lo, self.hi)
+
+
+def parse_range(value: str):
+    """Returns the Range of a '<lo>..<hi>' range, either end optional, or of a
+    '<value>~<tol>' tolerance in Da or '<value>~<tol>ppm'.
+    Returns None for anything else."""
+    m = re.match(r'^\s*([\d.]*)\.\.([\d.]*)\s*$', value)
+    if m is not None and any(m.groups()):
+        return Range(float(m.group(1) or '-inf'), float(m.group(2) or 'inf'))
+    m = re.match(r'^\s*([\d.]+)\s*~\s*([\d.]+)\s*(ppm)?\s*$', value,
+                 re.IGNORECASE)
+    if m is not None:
+        center, tol = float(m.group(1)), float(m.group(2))
+        if m.group(3) is not None:
+            tol *= center * 1e-6
+        return Range(center - tol, center + tol)
+    return None
+
+
+def is_collection(x):
+    return hasattr(x, '__len__') and not isinstance(x, str)
+
+
 def is_or_in_either(a, b):
-    if hasattr(b, '__len__'):
-        if hasattr(a, '__len__'):
+    if is_collection(b):
+        if is_collection(a):
             for x in a:
                 if x in b:
                     return True
         else:
             return a in b
     else:
-        if hasattr(a, '__len__'):
+        if is_collection(a):
             return b in a
         else:
             return a == b